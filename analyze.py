@@ -0,0 +1,174 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from analyzer import configure_logging, clean_url, is_valid_url, RENDER_MODES
+
+CSV_FIELDS = [
+    'url', 'compatible', 'max_image_preview_large', 'noindex', 'has_large_images',
+    'largest_image_url', 'largest_image_width', 'largest_image_height',
+    'total_static_images', 'total_dynamic_images', 'error'
+]
+
+def iter_input_urls(stream):
+    # One URL per line, blank lines and # comments are ignored
+    for line in stream:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+def read_done_urls(path, output_format, retry_errors=False):
+    # URLs already present in the output of an interrupted run are not analyzed again
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, newline='') as f:
+        if output_format == 'csv':
+            lines = csv.DictReader(f)
+        else:
+            lines = []
+            for raw in f:
+                try:
+                    lines.append(json.loads(raw))
+                except ValueError:
+                    # Last line cut short by the interruption
+                    continue
+        for line in lines:
+            if line.get('url') and not (retry_errors and line.get('error')):
+                done.add(line['url'])
+    return done
+
+def csv_row(line):
+    if 'error' in line:
+        return {'url': line['url'], 'error': line['error']}
+    largest = line['largest_images'][0] if line['largest_images'] else {}
+    return {
+        'url': line['url'],
+        'compatible': line['discover_compatibility']['compatible'],
+        'max_image_preview_large': line['robots_meta']['max_image_preview_large_found'],
+        'noindex': line['robots_meta']['noindex'],
+        'has_large_images': line['discover_compatibility']['has_large_images'],
+        'largest_image_url': largest.get('url'),
+        'largest_image_width': largest.get('width'),
+        'largest_image_height': largest.get('height'),
+        'total_static_images': line['analysis_info']['total_static_images'],
+        'total_dynamic_images': line['analysis_info']['total_dynamic_images']
+    }
+
+def analyze_one(url, options):
+    # Runs in a pool process, Playwright is only imported there once a browser is needed.
+    # Going through the cache lets unchanged pages be confirmed by their stored fingerprint
+    from analyzer import analyze_url_cached
+    try:
+        results, error = analyze_url_cached(url, **options)
+    except Exception as e:
+        results, error = None, str(e)
+    if error:
+        return {'url': url, 'error': error}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze the Google Discover compatibility of a list of URLs without the web server.')
+    parser.add_argument('input', nargs='?', default='-', help='file with one URL per line, - or nothing to read from stdin')
+    parser.add_argument('--output', help='write results to this file as they complete, an existing file is resumed (default: stdout)')
+    parser.add_argument('--format', choices=('jsonl', 'csv'), help='output format (default: from the output file extension, jsonl otherwise)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='number of analysis processes, each running at most one browser')
+    parser.add_argument('--render-mode', choices=RENDER_MODES, default='full', help='dynamic analysis render mode')
+    parser.add_argument('--static-only', action='store_true', help='skip the dynamic analysis, no browser is started')
+    parser.add_argument('--early-exit', action='store_true', help='stop probing images once one of at least 1200px is confirmed')
+    parser.add_argument('--bypass-cache', action='store_true', help='analyze every page again, even if its stored fingerprint still matches')
+    parser.add_argument('--retry-errors', action='store_true', help='when resuming, analyze again the URLs that ended in an error')
+    args = parser.parse_args()
+    # Console only: several processes rotating the same log file would lose lines
+    configure_logging()
+
+    output_format = args.format or ('csv' if (args.output or '').lower().endswith('.csv') else 'jsonl')
+    done = read_done_urls(args.output, output_format, args.retry_errors) if args.output else set()
+    if done:
+        print(f"Resuming: {len(done)} URLs already in {args.output}", file=sys.stderr)
+
+    options = {
+        'render_mode': args.render_mode,
+        'early_exit': args.early_exit,
+        'static_only': args.static_only,
+        'bypass_cache': args.bypass_cache
+    }
+    source = sys.stdin if args.input == '-' else open(args.input)
+    if args.output:
+        new_file = not os.path.exists(args.output) or os.path.getsize(args.output) == 0
+        output = open(args.output, 'a', newline='')
+    else:
+        new_file = True
+        output = sys.stdout
+    writer = None
+    if output_format == 'csv':
+        writer = csv.DictWriter(output, fieldnames=CSV_FIELDS)
+        if new_file:
+            writer.writeheader()
+
+    counts = {'completed': 0, 'errors': 0, 'skipped': 0}
+
+    def write(line):
+        counts['errors' if 'error' in line else 'completed'] += 1
+        if writer:
+            writer.writerow(csv_row(line))
+        else:
+            output.write(json.dumps(line) + '\n')
+        output.flush()
+
+    # Spawned processes import analyzer afresh and read their browser pool size from the environment
+    os.environ['BROWSER_POOL_SIZE'] = '1'
+    processes = max(args.processes, 1)
+    executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=configure_logging)
+    running = {}
+    seen = set()
+
+    def collect(future):
+        try:
+            line = future.result()
+        except Exception as e:
+            line = {'url': running[future], 'error': str(e)}
+        del running[future]
+        write(line)
+
+    interrupted = False
+    try:
+        for url in iter_input_urls(source):
+            url = clean_url(url)
+            if url in done or url in seen:
+                counts['skipped'] += 1
+                continue
+            seen.add(url)
+            if not is_valid_url(url):
+                write({'url': url, 'error': 'Invalid URL format'})
+                continue
+            # Keep a bounded number of URLs in flight so large inputs are streamed
+            while len(running) >= processes * 2:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    collect(future)
+            running[executor.submit(analyze_one, url, options)] = url
+        for future in list(running):
+            collect(future)
+    except KeyboardInterrupt:
+        # Everything written so far is kept, the next run with the same output resumes from there
+        interrupted = True
+    finally:
+        executor.shutdown(wait=not interrupted, cancel_futures=True)
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+
+    print(json.dumps(counts), file=sys.stderr)
+    if interrupted:
+        return 130
+    return 0 if not counts['errors'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,2704 @@
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image, UnidentifiedImageError
+from io import BytesIO
+import tempfile
+import os
+import logging
+from urllib.parse import urljoin, urlparse
+import json
+from logging.handlers import RotatingFileHandler
+import time
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, InvalidStateError, wait, FIRST_COMPLETED
+import queue
+import atexit
+import re
+import hashlib
+from collections import OrderedDict, deque
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import sqlite3
+import gzip
+import xml.etree.ElementTree as ET
+import codecs
+from html.parser import HTMLParser
+from contextlib import contextmanager
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+# Handlers are configured by the entry points, importing the library never touches logging
+logger = logging.getLogger(__name__)
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+def configure_logging(log_file=None):
+    # Called once by app.py, crawl.py and analyze.py: console output plus an optional rotating file.
+    # The first call wins, so a program importing app.py can keep its own configuration
+    if logging.getLogger().handlers:
+        return
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        handlers.append(RotatingFileHandler(log_file, maxBytes=10485760, backupCount=5))
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, handlers=handlers)
+
+def is_valid_url(url):
+    try:
+        # Clean up URL first
+        url = url.strip()
+        # Remove any accidental URL prefixes
+        if url.startswith('examphttps://'):
+            url = url.replace('examphttps://', 'https://')
+        # Remove any trailing "le.com" that might be mistakenly added
+        if url.endswith('/le.com'):
+            url = url[:-7]
+            
+        # Ensure URL starts with http:// or https://
+        if not url.startswith(('http://', 'https://')):
+            return False
+            
+        # Additional security checks
+        parsed = urlparse(url)
+        # Check for basic URL structure
+        if not all([parsed.scheme, parsed.netloc]):
+            return False
+        # Ensure scheme is http or https
+        if parsed.scheme not in ['http', 'https']:
+            return False
+        # Check for common injection patterns
+        dangerous_patterns = ['javascript:', 'data:', 'vbscript:', '<script', '-->']
+        if any(pattern in url.lower() for pattern in dangerous_patterns):
+            return False
+            
+        return True
+    except:
+        return False
+
+def clean_url(url):
+    url = url.strip()
+    if url.startswith('examphttps://'):
+        url = url.replace('examphttps://', 'https://')
+    if url.endswith('/le.com'):
+        url = url[:-7]
+    return url
+
+# Robots directives
+ROBOTS_META_NAMES = ('robots', 'googlebot')
+IMAGE_PREVIEW_LEVELS = ('none', 'standard', 'large')
+VALUED_DIRECTIVES = {'max-image-preview', 'max-snippet', 'max-video-preview', 'unavailable_after'}
+
+def split_directives(content):
+    # 'max-image-preview : large' and 'max-image-preview:large' are the same directive
+    for part in content.split(','):
+        part = part.strip().lower()
+        if ':' in part:
+            name, value = part.split(':', 1)
+            part = f'{name.strip()}:{value.strip()}'
+        if part:
+            yield part
+
+def split_x_robots_tag(header):
+    # Returns the directives of an X-Robots-Tag header that apply to Googlebot.
+    # A 'useragent:' prefix applies to every directive that follows it.
+    applies = True
+    directives = []
+    for directive in split_directives(header or ''):
+        name, _, value = directive.partition(':')
+        if value and name not in VALUED_DIRECTIVES and ' ' not in name:
+            applies = name in ROBOTS_META_NAMES
+            if not applies:
+                continue
+            directive = value.strip()
+            if not directive:
+                continue
+            directive = next(split_directives(directive), '')
+        if applies:
+            directives.append(directive)
+    return directives
+
+def parse_robots_directives(robots_metas, x_robots_tag=None):
+    # Single pass over the robots/googlebot metas and the X-Robots-Tag header.
+    # Conflicting directives resolve to the most restrictive one.
+    sources = []
+    directives = []
+    for meta in robots_metas:
+        if meta['name'] not in ROBOTS_META_NAMES:
+            continue
+        sources.append({'source': f"meta:{meta['name']}", 'content': meta['content']})
+        directives.extend(split_directives(meta['content']))
+    if x_robots_tag:
+        sources.append({'source': 'header:x-robots-tag', 'content': x_robots_tag})
+        directives.extend(split_x_robots_tag(x_robots_tag))
+    
+    noindex = False
+    image_preview = None
+    for directive in directives:
+        name, _, value = directive.partition(':')
+        if name in ('noindex', 'none'):
+            noindex = True
+        elif name == 'max-image-preview' and value in IMAGE_PREVIEW_LEVELS:
+            if image_preview is None or IMAGE_PREVIEW_LEVELS.index(value) < IMAGE_PREVIEW_LEVELS.index(image_preview):
+                image_preview = value
+    
+    return {
+        'max_image_preview': image_preview,
+        'max_image_preview_large': image_preview == 'large' and not noindex,
+        'noindex': noindex,
+        'directives': sorted(set(directives)),
+        'sources': sources
+    }
+
+# Streaming HTML extraction
+STATIC_HTML_PARSER = os.environ.get('STATIC_HTML_PARSER', 'stream')
+HTML_CHUNK_SIZE = 65536
+HTML_CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset=["\']?([a-zA-Z0-9_-]+)', re.IGNORECASE)
+OG_IMAGE_PROPERTIES = {'og:image', 'og:image:url', 'og:image:secure_url'}
+
+def parse_dimension(value):
+    # Accepts 1200, '1200', '1200px' and schema.org QuantitativeValue objects, percentages give None
+    if isinstance(value, dict):
+        value = value.get('value')
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        # Relative sizes such as 50% say nothing about the image itself
+        if value.strip().endswith('%'):
+            return None
+        match = re.match(r'\s*(\d+)', value)
+        if match:
+            return int(match.group(1))
+    return None
+
+def collect_json_ld_images(node, images, depth=0):
+    # Walks JSON-LD for ImageObject nodes and plain 'image' URLs
+    if depth > 10:
+        return
+    if isinstance(node, list):
+        for item in node:
+            collect_json_ld_images(item, images, depth + 1)
+    elif isinstance(node, dict):
+        node_type = node.get('@type')
+        node_types = node_type if isinstance(node_type, list) else [node_type]
+        if 'ImageObject' in node_types:
+            url = node.get('contentUrl') or node.get('url')
+            if isinstance(url, str):
+                images.append({'url': url, 'width': parse_dimension(node.get('width')), 'height': parse_dimension(node.get('height'))})
+        for key, value in node.items():
+            if key == 'image' and isinstance(value, str):
+                images.append({'url': value, 'width': None, 'height': None})
+            elif key == 'image' and isinstance(value, list):
+                for item in value:
+                    if isinstance(item, str):
+                        images.append({'url': item, 'width': None, 'height': None})
+                    else:
+                        collect_json_ld_images(item, images, depth + 1)
+            elif isinstance(value, (dict, list)):
+                collect_json_ld_images(value, images, depth + 1)
+
+class PageDataCollector:
+    # Collects the tags the static analysis needs while the document is parsed
+    def __init__(self):
+        self.data = {
+            'robots_metas': [],
+            'images': [],
+            'sources': [],
+            'og_images': [],
+            'json_ld_images': []
+        }
+        self.picture_depth = 0
+        self.json_ld_parts = None
+
+    def start(self, tag, attrs):
+        if tag == 'script' and 'ld+json' in (attrs.get('type') or '').lower():
+            self.json_ld_parts = []
+        elif tag == 'meta':
+            name = (attrs.get('name') or '').strip().lower()
+            prop = (attrs.get('property') or '').strip().lower()
+            content = attrs.get('content') or ''
+            if name == 'robots' or name.startswith('googlebot'):
+                self.data['robots_metas'].append({'name': name, 'content': content})
+            if prop in OG_IMAGE_PROPERTIES and content:
+                self.data['og_images'].append({'url': content.strip()})
+            elif prop in ('og:image:width', 'og:image:height') and self.data['og_images']:
+                self.data['og_images'][-1][prop.rsplit(':', 1)[-1]] = content.strip()
+        elif tag == 'img':
+            self.data['images'].append({
+                key: attrs.get(key) for key in ('src', 'srcset', 'sizes', 'width', 'height', 'data-src', 'data-srcset')
+            })
+        elif tag == 'picture':
+            self.picture_depth += 1
+        elif tag == 'source' and self.picture_depth:
+            self.data['sources'].append({
+                key: attrs.get(key) for key in ('srcset', 'sizes', 'media', 'type', 'width', 'height')
+            })
+
+    def end(self, tag):
+        if tag == 'picture' and self.picture_depth:
+            self.picture_depth -= 1
+        elif tag == 'script' and self.json_ld_parts is not None:
+            try:
+                collect_json_ld_images(json.loads(''.join(self.json_ld_parts)), self.data['json_ld_images'])
+            except ValueError:
+                pass
+            self.json_ld_parts = None
+
+    def text(self, text):
+        if self.json_ld_parts is not None:
+            self.json_ld_parts.append(text)
+
+    def close(self):
+        return self.data
+
+class _StdlibHTMLDriver(HTMLParser):
+    def __init__(self, collector):
+        super().__init__(convert_charrefs=True)
+        self.collector = collector
+
+    def handle_starttag(self, tag, attrs):
+        self.collector.start(tag, {name: value for name, value in attrs})
+
+    def handle_endtag(self, tag):
+        self.collector.end(tag)
+
+    def handle_data(self, data):
+        self.collector.text(data)
+
+class _LxmlTarget:
+    def __init__(self, collector):
+        self.collector = collector
+
+    def start(self, tag, attrib):
+        if isinstance(tag, str):
+            self.collector.start(tag.lower(), dict(attrib))
+
+    def end(self, tag):
+        if isinstance(tag, str):
+            self.collector.end(tag.lower())
+
+    def data(self, text):
+        self.collector.text(text)
+
+    def close(self):
+        return self.collector.close()
+
+def normalize_encoding(name):
+    # Charsets announced by servers are often unknown to Python (utf8mb4, none, ...)
+    try:
+        return codecs.lookup(name).name
+    except (LookupError, TypeError):
+        return 'utf-8'
+
+def detect_html_encoding(first_chunk, response):
+    match = HTML_CHARSET_PATTERN.search(first_chunk[:2048])
+    if match:
+        try:
+            return codecs.lookup(match.group(1).decode('ascii')).name
+        except LookupError:
+            pass
+    content_type = response.headers.get('Content-Type', '')
+    if 'charset=' in content_type.lower():
+        return normalize_encoding(response.encoding)
+    return 'utf-8'
+
+def extract_page_data(chunks, encoding):
+    # Single event-based pass over the body chunks, lxml when installed,
+    # the standard library tokenizer otherwise
+    collector = PageDataCollector()
+    if lxml_etree is not None:
+        parser = lxml_etree.HTMLParser(target=_LxmlTarget(collector), encoding=encoding)
+        feed = parser.feed
+    else:
+        parser = _StdlibHTMLDriver(collector)
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        feed = lambda chunk: parser.feed(decoder.decode(chunk))
+    for chunk in chunks:
+        feed(chunk)
+    parser.close()
+    return collector.close()
+
+def extract_page_data_from_soup(soup):
+    collector = PageDataCollector()
+    for tag in soup.find_all(['meta', 'img', 'source', 'script']):
+        in_picture = tag.name == 'source' and tag.find_parent('picture') is not None
+        if tag.name == 'source' and not in_picture:
+            continue
+        collector.picture_depth = int(in_picture)
+        collector.start(tag.name, {name: ' '.join(value) if isinstance(value, list) else value for name, value in tag.attrs.items()})
+        if tag.name == 'script':
+            collector.text(tag.string or '')
+            collector.end('script')
+    return collector.close()
+
+# Metrics
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+ATTEMPT_BUCKETS = (1, 2, 3, 5)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+class Metrics:
+    # Labelled counters and histograms kept in memory, rendered in the
+    # Prometheus text exposition format by the /metrics route
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.help = {}
+        self.buckets = {}
+        self.values = {}
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self.kinds[name] = kind
+        self.help[name] = help_text
+        self.buckets[name] = buckets
+        self.values[name] = {}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self.buckets[name]
+        with self.lock:
+            series = self.values[name].get(key)
+            if series is None:
+                series = self.values[name][key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            # Buckets are cumulative: a value is counted in every bucket above it
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self, sampled=()):
+        # sampled: (name, kind, help, [(labels, value)]) read from other components at scrape time
+        lines = []
+        with self.lock:
+            for name, kind in self.kinds.items():
+                lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, series in self.values[name].items():
+                    if kind != 'histogram':
+                        lines.append(f"{name}{format_labels(key)} {series}")
+                        continue
+                    for bound, count in zip(self.buckets[name], series['buckets']):
+                        lines.append(f"{name}_bucket{format_labels(key + (('le', bound),))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', '+Inf'),))} {series['count']}")
+                    lines.append(f"{name}_sum{format_labels(key)} {series['sum']}")
+                    lines.append(f"{name}_count{format_labels(key)} {series['count']}")
+        for name, kind, help_text, samples in sampled:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('analysis_stage_seconds', 'histogram', 'Duration of each analysis stage in seconds', STAGE_BUCKETS)
+metrics.describe('analysis_bytes_total', 'counter', 'Bytes downloaded by analyses')
+metrics.describe('analyses_total', 'counter', 'Analyses run, by outcome')
+metrics.describe('dynamic_analysis_attempts', 'histogram', 'Browser attempts needed by a dynamic analysis', ATTEMPT_BUCKETS)
+metrics.describe('http_retries_total', 'counter', 'HTTP requests retried after a throttling answer')
+metrics.describe('browser_launch_seconds', 'histogram', 'Time taken to launch a browser', STAGE_BUCKETS)
+
+class AnalysisTimings:
+    # Stage durations and byte counts of one analysis, recorded from the threads of
+    # the static and dynamic passes and fed to the stage histogram as they happen
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.bytes = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - started)
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+        metrics.observe('analysis_stage_seconds', seconds, stage=name)
+
+    def add_bytes(self, kind, count):
+        if not count:
+            return
+        with self.lock:
+            self.bytes[kind] = self.bytes.get(kind, 0) + count
+        metrics.inc('analysis_bytes_total', count, kind=kind)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'stages_ms': {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()},
+                'bytes': dict(self.bytes)
+            }
+
+# Shared HTTP client
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', 100))
+HTTP_POOL_MAX_PER_HOST = int(os.environ.get('HTTP_POOL_MAX_PER_HOST', 16))
+
+class HTTPClient:
+    # Keeps one pool of keep-alive connections for the whole process, so consecutive
+    # analyses of a domain reuse its connections. The adapter's pool manager is
+    # thread-safe; each thread gets its own Session on top of it. Cookies only live for
+    # one request and its redirect chain, so no state leaks from one analysis to the next.
+    def __init__(self, pool_hosts, pool_max_per_host):
+        self.adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_max_per_host)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'sessions': 0}
+
+    def session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self.local.session = session
+            with self.lock:
+                self.stats['sessions'] += 1
+        return session
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            self.stats['requests'] += 1
+        session = self.session()
+        # Consent and cookie-check redirects still work, the jar is emptied for the next request
+        session.cookies.clear()
+        return session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def pool_stats(self):
+        pools = self.adapter.poolmanager.pools
+        hosts = []
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            hosts.append({
+                'host': f"{pool.scheme}://{pool.host}:{pool.port}",
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+                # The pool queue is padded with None placeholders up to its size
+                'idle_connections': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+            })
+        opened = sum(host['connections_opened'] for host in hosts)
+        sent = sum(host['requests'] for host in hosts)
+        return {
+            'requests': self.stats['requests'],
+            'sessions': self.stats['sessions'],
+            'pooled_hosts': len(hosts),
+            'connections_opened': opened,
+            'connections_reused': max(sent - opened, 0),
+            'idle_connections': sum(host['idle_connections'] for host in hosts),
+            'hosts': hosts
+        }
+
+http_client = HTTPClient(HTTP_POOL_HOSTS, HTTP_POOL_MAX_PER_HOST)
+
+# Per-host politeness
+HOST_MAX_RATE = float(os.environ.get('HOST_MAX_RATE', 20))
+HOST_MAX_BACKOFF = float(os.environ.get('HOST_MAX_BACKOFF', 120))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 30))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 2))
+THROTTLE_STATUS_CODES = (429, 503)
+
+class HostThrottled(Exception):
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"Throttled with HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+def backoff_delay(attempt):
+    # Exponential backoff with jitter: half of the delay is fixed, half is random
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class HostScheduler:
+    # Spaces out the requests started against each host and pauses a host once it
+    # answered 429/503, for its Retry-After or an exponential backoff
+    def __init__(self, max_rate, max_backoff):
+        self.min_interval = 1 / max_rate if max_rate > 0 else 0
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.next_slot = {}
+        self.blocked_until = {}
+        self.strikes = {}
+        self.stats = {'waits': 0, 'wait_seconds': 0.0, 'throttled': 0}
+
+    def pending_delay(self, host):
+        with self.lock:
+            return max(self.next_slot.get(host, 0), self.blocked_until.get(host, 0)) - time.monotonic()
+
+    def wait(self, host, deadline=None, cancel_event=None):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, 0), self.blocked_until.get(host, 0))
+            if deadline is not None and slot >= deadline:
+                raise TimeoutError(f"{host} is rate limited beyond the deadline")
+            self.next_slot[host] = slot + self.min_interval
+            if len(self.next_slot) > 10000:
+                self._prune(now)
+        delay = slot - now
+        if delay <= 0:
+            return
+        self.stats['waits'] += 1
+        self.stats['wait_seconds'] += delay
+        if cancel_event is None:
+            time.sleep(delay)
+        elif cancel_event.wait(delay):
+            raise AnalysisCancelled()
+
+    def throttled(self, host, retry_after=None):
+        # Returns how long the host is paused
+        with self.lock:
+            self.strikes[host] = self.strikes.get(host, 0) + 1
+            delay = retry_after if retry_after is not None else backoff_delay(self.strikes[host] - 1)
+            delay = min(delay, self.max_backoff)
+            self.blocked_until[host] = max(self.blocked_until.get(host, 0), time.monotonic() + delay)
+            self.stats['throttled'] += 1
+        logger.warning(f"{host} is throttling requests, pausing it for {delay:.1f}s")
+        return delay
+
+    def succeeded(self, host):
+        if host in self.strikes:
+            with self.lock:
+                self.strikes.pop(host, None)
+
+    def _prune(self, now):
+        for table in (self.next_slot, self.blocked_until):
+            for host in [host for host, until in table.items() if until < now]:
+                del table[host]
+
+host_scheduler = HostScheduler(HOST_MAX_RATE, HOST_MAX_BACKOFF)
+
+def scheduled_get(url, deadline=None, cancel_event=None, max_retries=HTTP_MAX_RETRIES, **kwargs):
+    # GET through the host scheduler. Throttled responses are retried while the deadline
+    # allows it, otherwise the last one is returned to the caller as is.
+    host = urlparse(url).netloc
+    attempt = 0
+    while True:
+        host_scheduler.wait(host, deadline, cancel_event)
+        response = http_client.get(url, **kwargs)
+        if response.status_code not in THROTTLE_STATUS_CODES:
+            host_scheduler.succeeded(host)
+            return response
+        delay = host_scheduler.throttled(host, parse_retry_after(response.headers.get('Retry-After')))
+        if attempt >= max_retries or (deadline is not None and time.monotonic() + delay >= deadline):
+            return response
+        response.close()
+        attempt += 1
+        metrics.inc('http_retries_total', status=response.status_code)
+
+# Image header probing
+IMAGE_PROBE_CHUNK_SIZE = 8192
+IMAGE_PROBE_MAX_HEADER_BYTES = 262144
+# Guards of the Pillow fallback, the only path that may buffer a large part of an image
+IMAGE_DECODE_MAX_BYTES = int(os.environ.get('IMAGE_DECODE_MAX_BYTES', 10 * 1024 * 1024))
+# Checked on the size read by Image.open, Pillow's own global limit is left untouched
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 100_000_000))
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+ISOBMFF_CONTAINER_BOXES = {b'meta', b'iprp', b'ipco'}
+
+class ImageSkipped(Exception):
+    # Raised when an image is not probed to protect the memory of the worker
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+class ImageHeaderNeedMoreData(Exception):
+    pass
+
+def _parse_jpeg_header(data):
+    pos = 2
+    while True:
+        # Skip padding bytes before the marker
+        while pos < len(data) and data[pos] == 0xFF:
+            pos += 1
+        if pos >= len(data):
+            raise ImageHeaderNeedMoreData()
+        marker = data[pos]
+        pos += 1
+        # Standalone markers have no length field
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue
+        if marker in (0xD9, 0xDA):
+            raise ValueError('JPEG scan reached before SOF marker')
+        if pos + 2 > len(data):
+            raise ImageHeaderNeedMoreData()
+        segment_length = struct.unpack('>H', data[pos:pos + 2])[0]
+        if segment_length < 2:
+            raise ValueError('Invalid JPEG segment length')
+        if marker in JPEG_SOF_MARKERS:
+            if pos + 7 > len(data):
+                raise ImageHeaderNeedMoreData()
+            height, width = struct.unpack('>HH', data[pos + 3:pos + 7])
+            return width, height, 'JPEG'
+        pos += segment_length
+
+def _parse_webp_header(data):
+    if len(data) < 30:
+        raise ImageHeaderNeedMoreData()
+    chunk = data[12:16]
+    if chunk == b'VP8 ':
+        if data[23:26] != b'\x9d\x01\x2a':
+            raise ValueError('Invalid VP8 frame header')
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3FFF, height & 0x3FFF, 'WEBP'
+    if chunk == b'VP8L':
+        if data[20] != 0x2F:
+            raise ValueError('Invalid VP8L signature')
+        bits = struct.unpack('<I', data[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, 'WEBP'
+    if chunk == b'VP8X':
+        width = int.from_bytes(data[24:27], 'little') + 1
+        height = int.from_bytes(data[27:30], 'little') + 1
+        return width, height, 'WEBP'
+    raise ValueError('Unknown WebP chunk')
+
+def _find_ispe_sizes(data, start, end, sizes):
+    pos = start
+    while pos < end:
+        if pos + 8 > len(data):
+            raise ImageHeaderNeedMoreData()
+        box_size, box_type = struct.unpack('>I4s', data[pos:pos + 8])
+        header_size = 8
+        if box_size == 1:
+            if pos + 16 > len(data):
+                raise ImageHeaderNeedMoreData()
+            box_size = struct.unpack('>Q', data[pos + 8:pos + 16])[0]
+            header_size = 16
+        elif box_size == 0:
+            box_size = end - pos
+        if box_size < header_size:
+            raise ValueError('Invalid ISOBMFF box size')
+        box_end = pos + box_size
+        if box_type == b'ispe':
+            if pos + header_size + 12 > len(data):
+                raise ImageHeaderNeedMoreData()
+            width, height = struct.unpack('>II', data[pos + header_size + 4:pos + header_size + 12])
+            sizes.append((width, height))
+        elif box_type in ISOBMFF_CONTAINER_BOXES:
+            # 'meta' is a full box with 4 bytes of version and flags
+            child_start = pos + header_size + (4 if box_type == b'meta' else 0)
+            _find_ispe_sizes(data, child_start, box_end, sizes)
+            if box_type == b'meta':
+                return
+        elif box_type == b'mdat' and not sizes:
+            raise ValueError('ISOBMFF media data found before item properties')
+        pos = box_end
+    if end == float('inf'):
+        raise ImageHeaderNeedMoreData()
+
+def _parse_avif_header(data):
+    sizes = []
+    _find_ispe_sizes(data, 0, float('inf'), sizes)
+    if not sizes:
+        raise ValueError('No ispe box found')
+    width, height = max(sizes, key=lambda size: size[0] * size[1])
+    return width, height, 'AVIF'
+
+def parse_image_header(data):
+    # Returns (width, height, format), raises ImageHeaderNeedMoreData when the
+    # buffer is too short and ValueError when the format is not supported
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        if len(data) < 24:
+            raise ImageHeaderNeedMoreData()
+        if data[12:16] != b'IHDR':
+            raise ValueError('PNG without IHDR chunk')
+        width, height = struct.unpack('>II', data[16:24])
+        return width, height, 'PNG'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        if len(data) < 10:
+            raise ImageHeaderNeedMoreData()
+        width, height = struct.unpack('<HH', data[6:10])
+        return width, height, 'GIF'
+    if data.startswith(b'\xff\xd8'):
+        return _parse_jpeg_header(data)
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return _parse_webp_header(data)
+    if data[4:8] == b'ftyp':
+        if len(data) < 12:
+            raise ImageHeaderNeedMoreData()
+        if data[8:12] in (b'avif', b'avis', b'mif1', b'heic', b'heix'):
+            return _parse_avif_header(data)
+    if len(data) < 12:
+        raise ImageHeaderNeedMoreData()
+    raise ValueError('Unsupported image format')
+
+def probe_image_dimensions(img_url, headers, timeout=10, known=None, deadline=None):
+    # Streams the image and stops reading as soon as its dimensions are known.
+    # Pillow is only used when header parsing fails, within memory guards.
+    # With known metadata from the image cache, a matching validator avoids the parse.
+    if known and known.get('etag'):
+        headers = dict(headers, **{'If-None-Match': known['etag']})
+    img_response = scheduled_get(img_url, deadline=deadline, headers=headers, timeout=timeout, verify=True, stream=True)
+    try:
+        img_response.raise_for_status()
+        etag = img_response.headers.get('ETag')
+        content_length = img_response.headers.get('Content-Length')
+        content_length = int(content_length) if content_length and content_length.isdigit() else None
+        if known and (img_response.status_code == 304
+                      or (etag and etag == known.get('etag'))
+                      or (not etag and content_length and content_length == known.get('content_length'))):
+            return dict(known, bytes_read=0, method='revalidated')
+        chunks = img_response.iter_content(chunk_size=IMAGE_PROBE_CHUNK_SIZE)
+        buffer = b''
+        bytes_read = 0
+        for chunk in chunks:
+            buffer += chunk
+            bytes_read += len(chunk)
+            try:
+                width, height, image_format = parse_image_header(buffer)
+                return {
+                    'width': width,
+                    'height': height,
+                    'format': image_format,
+                    'bytes_read': bytes_read,
+                    'method': 'header',
+                    'etag': etag,
+                    'content_length': content_length
+                }
+            except ImageHeaderNeedMoreData:
+                if bytes_read < IMAGE_PROBE_MAX_HEADER_BYTES:
+                    continue
+            except ValueError as e:
+                logger.debug(f"Header parsing failed for {img_url}: {str(e)}")
+            break
+
+        # Fallback: let Pillow identify the image from a growing buffer. Image.open only
+        # reads the header, pixels are never decoded. The buffer is bounded by a byte budget.
+        if content_length and content_length > IMAGE_DECODE_MAX_BYTES:
+            raise ImageSkipped('too large to decode')
+        next_attempt = len(buffer)
+        while True:
+            if len(buffer) >= next_attempt:
+                try:
+                    with Image.open(BytesIO(buffer)) as img_data:
+                        width, height = img_data.size
+                        image_format = img_data.format
+                    break
+                except Image.DecompressionBombError:
+                    raise ImageSkipped('too many pixels to decode')
+                except (UnidentifiedImageError, OSError, SyntaxError, struct.error):
+                    next_attempt = len(buffer) * 2
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError('Image could not be identified')
+            if bytes_read + len(chunk) > IMAGE_DECODE_MAX_BYTES:
+                raise ImageSkipped('decode byte budget exceeded')
+            buffer += chunk
+            bytes_read += len(chunk)
+        if width * height > IMAGE_MAX_PIXELS:
+            raise ImageSkipped('too many pixels to decode')
+        return {
+            'width': width,
+            'height': height,
+            'format': image_format,
+            'bytes_read': bytes_read,
+            'method': 'pillow',
+            'etag': etag,
+            'content_length': content_length
+        }
+    finally:
+        img_response.close()
+
+DISCOVER_MIN_WIDTH = 1200
+REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Connection': 'keep-alive',
+}
+
+class AnalysisCancelled(Exception):
+    pass
+
+class PageFetchError(Exception):
+    # The page itself answered with a non-2xx status, there is nothing to audit
+    def __init__(self, status, url):
+        super().__init__(f"Page returned HTTP {status}: {url}")
+        self.status = status
+
+# Concurrent image fetching
+STATIC_IMAGE_MAX_WORKERS = int(os.environ.get('STATIC_IMAGE_MAX_WORKERS', 16))
+STATIC_IMAGE_MAX_PER_HOST = int(os.environ.get('STATIC_IMAGE_MAX_PER_HOST', 4))
+STATIC_IMAGE_PAGE_DEADLINE = float(os.environ.get('STATIC_IMAGE_PAGE_DEADLINE', 20))
+STATIC_IMAGE_TIMEOUT = 10
+
+class HostDispatcher:
+    # Hands tasks to a shared pool host by host: a task only reaches the pool once
+    # its host has a free slot, so no pool worker ever sleeps waiting for a host
+    def __init__(self, executor, max_per_host):
+        self.executor = executor
+        self.max_per_host = max_per_host
+        self.lock = threading.Lock()
+        self.running = {}
+        self.queued = {}
+
+    def submit(self, host, deadline, fn, *args):
+        future = Future()
+        with self.lock:
+            if self.running.get(host, 0) >= self.max_per_host:
+                self.queued.setdefault(host, deque()).append((future, deadline, fn, args))
+                return future
+            self.running[host] = self.running.get(host, 0) + 1
+        future.set_running_or_notify_cancel()
+        self._start(host, future, fn, args)
+        return future
+
+    def _start(self, host, future, fn, args):
+        def run():
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self._release(host)
+        self.executor.submit(run)
+
+    def _release(self, host):
+        while True:
+            with self.lock:
+                queued = self.queued.get(host)
+                if not queued:
+                    self.queued.pop(host, None)
+                    self.running[host] -= 1
+                    if not self.running[host]:
+                        del self.running[host]
+                    return
+                future, deadline, fn, args = queued.popleft()
+            # Tasks abandoned while queued give their turn to the next one
+            if not future.set_running_or_notify_cancel():
+                continue
+            if time.monotonic() >= deadline:
+                future.set_exception(TimeoutError('Page deadline reached while waiting for a host slot'))
+                continue
+            self._start(host, future, fn, args)
+            return
+
+# Shared by all analyses so the worker count is a process-wide cap
+image_executor = ThreadPoolExecutor(max_workers=STATIC_IMAGE_MAX_WORKERS, thread_name_prefix='image-probe')
+image_dispatcher = HostDispatcher(image_executor, STATIC_IMAGE_MAX_PER_HOST)
+
+# Image metadata cache shared across pages
+IMAGE_CACHE_PATH = os.environ.get('IMAGE_CACHE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'images.sqlite3'))
+IMAGE_CACHE_MAX_ENTRIES = int(os.environ.get('IMAGE_CACHE_MAX_ENTRIES', 100000))
+IMAGE_CACHE_TTL = float(os.environ.get('IMAGE_CACHE_TTL', 7 * 24 * 3600))
+
+class ImageMetadataCache:
+    # Maps an image URL to its dimensions and validators in a SQLite file.
+    # Fresh entries skip the fetch, stale ones are revalidated by the probe.
+    def __init__(self, path, max_entries, ttl):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.local = threading.local()
+        self.evict_lock = threading.Lock()
+        self.stats = {'hits': 0, 'stale': 0, 'misses': 0, 'revalidated': 0, 'evictions': 0}
+
+    def _connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS image_meta (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    content_length INTEGER,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL,
+                    format TEXT,
+                    updated_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS image_meta_last_used ON image_meta (last_used)')
+            self.local.conn = conn
+        return conn
+
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['stale'] + self.stats['misses']
+        return (self.stats['hits'] + self.stats['revalidated']) / lookups if lookups else 0.0
+
+    def get(self, url):
+        # Returns (entry, fresh) or (None, False)
+        if not self.path:
+            return None, False
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                'SELECT etag, content_length, width, height, format, updated_at FROM image_meta WHERE url = ?', (url,)
+            ).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None, False
+            now = time.time()
+            conn.execute('UPDATE image_meta SET last_used = ? WHERE url = ?', (now, url))
+        except sqlite3.Error as e:
+            logger.warning(f"Image cache lookup failed: {str(e)}")
+            return None, False
+        fresh = now - row[5] < self.ttl
+        self.stats['hits' if fresh else 'stale'] += 1
+        return {
+            'etag': row[0],
+            'content_length': row[1],
+            'width': row[2],
+            'height': row[3],
+            'format': row[4]
+        }, fresh
+
+    def put(self, url, probe):
+        if not self.path:
+            return
+        if probe['method'] == 'revalidated':
+            self.stats['revalidated'] += 1
+        try:
+            now = time.time()
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO image_meta VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (url, probe.get('etag'), probe.get('content_length'), probe['width'], probe['height'],
+                 probe.get('format'), now, now)
+            )
+            self._evict(conn)
+        except sqlite3.Error as e:
+            logger.warning(f"Image cache write failed: {str(e)}")
+
+    def _evict(self, conn):
+        # Removes the least recently used tenth once the size bound is exceeded
+        if not self.evict_lock.acquire(blocking=False):
+            return
+        try:
+            count = conn.execute('SELECT COUNT(*) FROM image_meta').fetchone()[0]
+            if count > self.max_entries:
+                excess = count - self.max_entries + self.max_entries // 10
+                conn.execute(
+                    'DELETE FROM image_meta WHERE url IN (SELECT url FROM image_meta ORDER BY last_used LIMIT ?)', (excess,)
+                )
+                self.stats['evictions'] += excess
+        finally:
+            self.evict_lock.release()
+
+image_cache = ImageMetadataCache(IMAGE_CACHE_PATH, IMAGE_CACHE_MAX_ENTRIES, IMAGE_CACHE_TTL)
+
+def fetch_image_dimensions(img_url, headers, deadline, known=None):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError('Page deadline reached before fetch started')
+    probe = probe_image_dimensions(img_url, headers, timeout=max(min(STATIC_IMAGE_TIMEOUT, remaining), 0.1),
+                                  known=known, deadline=deadline)
+    image_cache.put(img_url, probe)
+    return probe
+
+# Concurrent analyses waiting for the same image share a single fetch
+inflight_images = {}
+inflight_images_lock = threading.Lock()
+
+def submit_image_probe(img_url, headers, deadline, known=None):
+    # Each caller gets its own future: cancelling it only cancels the shared
+    # fetch once no other analysis is waiting for that image
+    with inflight_images_lock:
+        entry = inflight_images.get(img_url)
+        created = entry is None
+        if created:
+            shared = image_dispatcher.submit(urlparse(img_url).netloc, deadline, fetch_image_dimensions,
+                                             img_url, headers, deadline, known)
+            entry = inflight_images[img_url] = {'future': shared, 'waiters': 0}
+        entry['waiters'] += 1
+    shared = entry['future']
+    proxy = Future()
+    
+    def forget(_):
+        with inflight_images_lock:
+            if inflight_images.get(img_url) is entry:
+                del inflight_images[img_url]
+    
+    def relay(_):
+        if proxy.done():
+            return
+        try:
+            if shared.cancelled():
+                proxy.cancel()
+            elif shared.exception() is not None:
+                proxy.set_exception(shared.exception())
+            else:
+                proxy.set_result(shared.result())
+        except InvalidStateError:
+            # The caller cancelled its future in the meantime
+            pass
+    
+    def abandon(_):
+        if not proxy.cancelled():
+            return
+        with inflight_images_lock:
+            entry['waiters'] -= 1
+            last = entry['waiters'] == 0
+        if last:
+            shared.cancel()
+    
+    proxy.add_done_callback(abandon)
+    if created:
+        shared.add_done_callback(forget)
+    shared.add_done_callback(relay)
+    return proxy
+
+# Image candidate ranking
+ICON_MAX_DISPLAY_SIZE = 64
+SRCSET_DESCRIPTOR_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)([wx])$')
+
+def parse_srcset(srcset):
+    # Returns (url, width, density) for every srcset entry. Follows the HTML
+    # tokenizer: a URL runs until whitespace, so CDN URLs may contain commas
+    entries = []
+    srcset = srcset or ''
+    position = 0
+    while position < len(srcset):
+        while position < len(srcset) and (srcset[position].isspace() or srcset[position] == ','):
+            position += 1
+        start = position
+        while position < len(srcset) and not srcset[position].isspace():
+            position += 1
+        url = srcset[start:position]
+        if not url:
+            break
+        descriptors = ''
+        if url.endswith(','):
+            # Trailing commas end the entry, it has no descriptor
+            url = url.rstrip(',')
+        else:
+            start = position
+            depth = 0
+            while position < len(srcset) and (srcset[position] != ',' or depth):
+                if srcset[position] == '(':
+                    depth += 1
+                elif srcset[position] == ')':
+                    depth = max(depth - 1, 0)
+                position += 1
+            descriptors = srcset[start:position]
+        if not url:
+            continue
+        width = None
+        density = None
+        for descriptor in descriptors.split():
+            match = SRCSET_DESCRIPTOR_PATTERN.match(descriptor)
+            if match and match.group(2) == 'w':
+                width = int(float(match.group(1)))
+            elif match:
+                density = float(match.group(1))
+        if width is None and density is None:
+            density = 1.0
+        entries.append((url, width, density))
+    return entries
+
+def largest_srcset_entry(srcset):
+    # Variants of one image: only the largest can decide the verdict
+    entries = parse_srcset(srcset)
+    if not entries:
+        return None, None
+    url, width, _ = max(entries, key=lambda entry: (entry[1] or 0, entry[2] or 0))
+    return url, width
+
+def collect_image_candidates(page_data, base_url):
+    # Returns the candidates worth probing, best first, and the skipped ones
+    candidates = {}
+    skipped = {}
+    order = [0]
+    
+    def add(raw_url, declared_width=None, display_width=None, origin='img'):
+        if not raw_url or raw_url.strip().lower().startswith('data:'):
+            return
+        img_url = urljoin(base_url, raw_url.strip())
+        if not img_url.startswith(('http://', 'https://')):
+            return
+        candidate = candidates.get(img_url)
+        if candidate is None:
+            order[0] += 1
+            candidates[img_url] = candidate = {'url': img_url, 'declared_width': None, 'display_width': None, 'origin': origin, 'order': order[0]}
+        if declared_width and declared_width > (candidate['declared_width'] or 0):
+            candidate['declared_width'] = declared_width
+        if display_width and display_width > (candidate['display_width'] or 0):
+            candidate['display_width'] = display_width
+    
+    for og_image in page_data['og_images']:
+        add(og_image['url'], parse_dimension(og_image.get('width')), origin='og:image')
+    for json_ld_image in page_data['json_ld_images']:
+        add(json_ld_image['url'], json_ld_image['width'], origin='json-ld')
+    for source in page_data['sources']:
+        srcset_url, srcset_width = largest_srcset_entry(source.get('srcset'))
+        add(srcset_url, srcset_width, origin='picture')
+    for img in page_data['images']:
+        display_width = parse_dimension(img.get('width'))
+        display_height = parse_dimension(img.get('height'))
+        src = img.get('src') or img.get('data-src')
+        if (display_width is not None and display_width <= ICON_MAX_DISPLAY_SIZE) or \
+                (display_height is not None and display_height <= ICON_MAX_DISPLAY_SIZE):
+            if src:
+                skipped[urljoin(base_url, src.strip())] = 'icon or tracking pixel'
+            continue
+        srcset = img.get('srcset') or img.get('data-srcset')
+        srcset_url, srcset_width = largest_srcset_entry(srcset)
+        if srcset_url:
+            add(srcset_url, srcset_width, display_width, origin='srcset')
+        if src:
+            # The src of an image with a srcset is usually one of its listed variants
+            srcset_widths = {urljoin(base_url, entry[0]): entry[1] for entry in parse_srcset(srcset)}
+            add(src, srcset_widths.get(urljoin(base_url, src.strip())), display_width, origin='img')
+    
+    ranked = []
+    for candidate in candidates.values():
+        if candidate['url'] in skipped:
+            del skipped[candidate['url']]
+        if urlparse(candidate['url']).path.lower().endswith('.svg'):
+            skipped[candidate['url']] = 'vector image'
+        elif candidate['declared_width'] is not None and candidate['declared_width'] < DISCOVER_MIN_WIDTH:
+            skipped[candidate['url']] = f'declared width below {DISCOVER_MIN_WIDTH}px'
+        else:
+            ranked.append(candidate)
+    # Declared large images first, then the others by displayed size and document order
+    ranked.sort(key=lambda c: (-(c['declared_width'] or 0), -(c['display_width'] or 0), c['order']))
+    return ranked, skipped
+
+def proves_compatibility(results, robots_directives):
+    return robots_directives['max_image_preview_large'] and any(img['width'] >= DISCOVER_MIN_WIDTH for img in results.values())
+
+HEAD_END_PATTERN = re.compile(rb'</head\s*>|<body[\s>]', re.I)
+HEAD_MAX_BYTES = 1024 * 1024
+
+def fetch_page_data(response, keep_body=False):
+    # Returns (page_data, recorded, size). recorded is the whole body when keep_body is
+    # set, otherwise only the bytes up to </head> needed by the fingerprint
+    full_record = keep_body or STATIC_HTML_PARSER != 'stream'
+    recorded = bytearray()
+    size = [0]
+    
+    def recorded_chunks():
+        head_done = False
+        for chunk in response.iter_content(chunk_size=HTML_CHUNK_SIZE):
+            size[0] += len(chunk)
+            if full_record or not head_done:
+                start = max(len(recorded) - 16, 0)
+                recorded.extend(chunk)
+                if not full_record:
+                    match = HEAD_END_PATTERN.search(recorded, start)
+                    if match or len(recorded) >= HEAD_MAX_BYTES:
+                        del recorded[match.end() if match else HEAD_MAX_BYTES:]
+                        head_done = True
+            yield chunk
+    
+    chunks = recorded_chunks()
+    if STATIC_HTML_PARSER == 'stream':
+        first_chunk = next(chunks, b'')
+        encoding = detect_html_encoding(first_chunk, response)
+        try:
+            page_data = extract_page_data(
+                (chunk for part in ([first_chunk], chunks) for chunk in part), encoding
+            )
+            return page_data, bytes(recorded), size[0]
+        except Exception as e:
+            logger.warning(f"Streaming HTML extraction failed, falling back to BeautifulSoup: {str(e)}")
+    
+    # Fallback: full BeautifulSoup tree of the whole document
+    from bs4 import BeautifulSoup
+    for _ in chunks:
+        pass
+    if full_record:
+        body = bytes(recorded)
+    else:
+        # Only the head was kept while streaming, the rare fallback fetches the page again
+        retry = scheduled_get(response.url, headers=REQUEST_HEADERS, timeout=30, verify=True)
+        retry.raise_for_status()
+        body = retry.content
+    encoding = normalize_encoding(response.encoding or response.apparent_encoding)
+    soup = BeautifulSoup(body.decode(encoding, errors='replace'), 'html.parser')
+    return extract_page_data_from_soup(soup), body if keep_body else bytes(recorded), size[0]
+
+# Content fingerprints
+HEAD_PATTERN = re.compile(rb'<head[\s>].*?</head\s*>', re.I | re.S)
+HEAD_VOLATILE_PATTERNS = [
+    # Inline scripts and comments often embed timestamps, nonces or session data,
+    # JSON-LD is kept because it declares images
+    re.compile(rb'<script(?![^>]*application/ld\+json)[^>]*>.*?</script\s*>', re.I | re.S),
+    re.compile(rb'<!--.*?-->', re.S),
+    re.compile(rb'\snonce="[^"]*"', re.I),
+]
+WHITESPACE_PATTERN = re.compile(rb'\s+')
+
+def page_fingerprint(body, candidates, skipped_images, x_robots_tag=None):
+    # Hash of the normalised <head> and of the ordered image candidates: two fetches with
+    # the same fingerprint lead to the same verdict. body may be the whole page or only
+    # the prefix kept by fetch_page_data, both are cut at the same place
+    end = HEAD_END_PATTERN.search(body)
+    body = body[:end.end() if end else HEAD_MAX_BYTES]
+    match = HEAD_PATTERN.search(body)
+    if match:
+        head = match.group(0)
+    else:
+        body_start = body.lower().find(b'<body')
+        head = body[:body_start] if body_start >= 0 else body
+    for pattern in HEAD_VOLATILE_PATTERNS:
+        head = pattern.sub(b'', head)
+    digest = hashlib.sha256(WHITESPACE_PATTERN.sub(b' ', head).strip())
+    for candidate in candidates:
+        digest.update(f"\n{candidate['url']} {candidate['declared_width']}".encode())
+    for img_url in sorted(skipped_images):
+        digest.update(f"\nskipped {img_url}".encode())
+    digest.update(f"\n{x_robots_tag or ''}".encode())
+    return digest.hexdigest()
+
+def fetch_page_fingerprint(url):
+    # Only the HTML is fetched: no image is probed and no browser is used
+    try:
+        response = scheduled_get(url, headers=REQUEST_HEADERS, timeout=30, verify=True, stream=True)
+        try:
+            response.raise_for_status()
+            page_data, head, _ = fetch_page_data(response)
+        finally:
+            response.close()
+        candidates, skipped_images = collect_image_candidates(page_data, response.url)
+        return page_fingerprint(head, candidates, skipped_images, response.headers.get('X-Robots-Tag'))
+    except Exception as e:
+        logger.warning(f"Fingerprint of {url} failed: {str(e)}")
+        return None
+
+def analyze_static_images(url, deadline=None, cancel_event=None, early_exit=False, on_document=None, keep_body=False,
+                          timings=None):
+    results = {}
+    skipped_images = {}
+    robots_directives = parse_robots_directives([])
+    document = None
+    try:
+        headers = dict(REQUEST_HEADERS)
+        
+        if deadline is None:
+            deadline = time.monotonic() + STATIC_IMAGE_PAGE_DEADLINE
+        if cancel_event is None:
+            cancel_event = threading.Event()
+        if timings is None:
+            timings = AnalysisTimings()
+        
+        with timings.stage('html_fetch'):
+            response = scheduled_get(url, deadline=deadline, cancel_event=cancel_event, headers=headers,
+                                     timeout=max(min(30, deadline - time.monotonic()), 1), verify=True, stream=True)
+            try:
+                if not 200 <= response.status_code < 300:
+                    raise PageFetchError(response.status_code, response.url)
+                page_data, body, body_size = fetch_page_data(response, keep_body=keep_body)
+            finally:
+                response.close()
+        timings.add_bytes('html', body_size)
+        robots_directives = parse_robots_directives(page_data['robots_metas'], response.headers.get('X-Robots-Tag'))
+        with timings.stage('candidate_ranking'):
+            candidates, skipped_images = collect_image_candidates(page_data, response.url)
+        document = {
+            'url': response.url,
+            'status': response.status_code,
+            'headers': dict(response.headers),
+            'body': body if keep_body else None,
+            'fingerprint': page_fingerprint(body, candidates, skipped_images, response.headers.get('X-Robots-Tag'))
+        }
+        del body
+        if on_document:
+            on_document(document)
+        
+        img_urls = [candidate['url'] for candidate in candidates]
+        logger.info(f"{len(img_urls)} image candidates to probe, {len(skipped_images)} skipped before fetching")
+        
+        probes_started = time.monotonic()
+        page_deadline = min(deadline, probes_started + STATIC_IMAGE_PAGE_DEADLINE)
+        futures = {}
+        for img_url in img_urls:
+            cached, fresh = image_cache.get(img_url)
+            if fresh:
+                future = Future()
+                future.set_result(dict(cached, bytes_read=0, method='cache'))
+            else:
+                future = submit_image_probe(img_url, headers, page_deadline, cached)
+            futures[future] = img_url
+        pending = set(futures)
+        stopped_reason = 'timed out'
+        while pending:
+            remaining = page_deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if cancel_event.is_set():
+                stopped_reason = 'cancelled'
+                break
+            # Short waits so a cancellation from the other pass is noticed quickly
+            done, pending = wait(pending, timeout=min(remaining, 0.5), return_when=FIRST_COMPLETED)
+            
+            for future in done:
+                img_url = futures[future]
+                try:
+                    probe = future.result()
+                    logger.info(f"Probed {img_url}: {probe['width']}x{probe['height']} {probe['format']} ({probe['bytes_read']} bytes read via {probe['method']})")
+                    results[img_url] = {
+                        'width': probe['width'],
+                        'height': probe['height'],
+                        'static': True,
+                        'dynamic': False,
+                        'area': probe['width'] * probe['height'],
+                        'bytes_read': probe['bytes_read'],
+                        'probe_method': probe['method']
+                    }
+                except TimeoutError:
+                    skipped_images[img_url] = 'timed out'
+                except ImageSkipped as e:
+                    logger.warning(f"Image {img_url} skipped: {e.reason}")
+                    skipped_images[img_url] = e.reason
+                except Exception as e:
+                    logger.warning(f"Error processing image {img_url}: {str(e)}")
+            
+            # With early_exit, one confirmed image decides the verdict and the other candidates
+            # are not needed. Otherwise they are all probed so largest_images is the real top 3
+            if pending and early_exit and any(img['width'] >= DISCOVER_MIN_WIDTH for img in results.values()):
+                logger.info(f"Image of at least {DISCOVER_MIN_WIDTH}px confirmed, skipping remaining candidates")
+                stopped_reason = 'not needed'
+                break
+        
+        # Queued fetches are dropped, running ones stop at the page deadline
+        for future in pending:
+            future.cancel()
+            skipped_images[futures[future]] = stopped_reason
+        if pending:
+            logger.warning(f"{len(pending)} images not checked by the static analysis ({stopped_reason})")
+        timings.record('image_probes', time.monotonic() - probes_started)
+        timings.add_bytes('images', sum(img['bytes_read'] for img in results.values()))
+    except PageFetchError:
+        # An error page must not be reported as a page without large images
+        raise
+    except Exception as e:
+        logger.error(f"Error in static analysis: {str(e)}")
+    return results, robots_directives, skipped_images, document
+
+# Browser pool
+BROWSER_POOL_SIZE = int(os.environ.get('BROWSER_POOL_SIZE', 2))
+BROWSER_MAX_PAGES = int(os.environ.get('BROWSER_MAX_PAGES', 50))
+BROWSER_LAUNCH_ARGS = ['--no-sandbox', '--disable-setuid-sandbox']
+DYNAMIC_JOB_TIMEOUT = 90
+
+class BrowserPool:
+    # Playwright's sync API is bound to the thread that started it, so each
+    # browser lives in its own worker thread and analyses are queued to them
+    def __init__(self, size, max_pages):
+        self.size = size
+        self.max_pages = max_pages
+        self.jobs = queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+        self.stats = {'launches': 0, 'recycles': 0, 'crashes': 0, 'pages': 0}
+
+    def start(self):
+        with self.lock:
+            if self.workers:
+                return
+            logger.info(f"Starting browser pool with {self.size} browsers")
+            for i in range(self.size):
+                worker = threading.Thread(target=self._worker, name=f'browser-{i}', daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def shutdown(self):
+        with self.lock:
+            for _ in self.workers:
+                self.jobs.put(None)
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.join(timeout=10)
+
+    def run(self, fn, context_options=None, timeout=DYNAMIC_JOB_TIMEOUT):
+        # Runs fn(context) in a fresh BrowserContext and returns its result
+        self.start()
+        future = Future()
+        self.jobs.put((fn, context_options or {}, future))
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            # A job still queued is dropped so no browser renders a page nobody waits for
+            future.cancel()
+            raise
+
+    def _launch(self, playwright):
+        started = time.monotonic()
+        browser = playwright.chromium.launch(args=BROWSER_LAUNCH_ARGS)
+        metrics.observe('browser_launch_seconds', time.monotonic() - started)
+        self.stats['launches'] += 1
+        return browser
+
+    def _worker(self):
+        # Playwright is only imported once a browser is actually needed
+        from playwright.sync_api import sync_playwright
+        while True:
+            try:
+                with sync_playwright() as p:
+                    self._serve(p)
+                    return
+            except Exception as e:
+                logger.error(f"Error initializing Playwright: {str(e)}")
+                # Fail the next job instead of leaving it waiting forever
+                job = self.jobs.get()
+                if job is None:
+                    return
+                if job[2].set_running_or_notify_cancel():
+                    job[2].set_exception(e)
+
+    def _serve(self, playwright):
+        browser = None
+        pages = 0
+        try:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    return
+                fn, context_options, future = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    if browser is not None and not browser.is_connected():
+                        logger.warning("Browser crashed, launching a new one")
+                        self.stats['crashes'] += 1
+                        browser = None
+                    if browser is None:
+                        browser = self._launch(playwright)
+                        pages = 0
+                    context = browser.new_context(**context_options)
+                    try:
+                        result = fn(context)
+                    finally:
+                        try:
+                            context.close()
+                        except Exception:
+                            pass
+                    future.set_result(result)
+                except Exception as e:
+                    future.set_exception(e)
+                pages += 1
+                self.stats['pages'] += 1
+                if browser is not None and (pages >= self.max_pages or not browser.is_connected()):
+                    logger.info(f"Recycling browser after {pages} pages")
+                    self.stats['recycles'] += 1
+                    try:
+                        browser.close()
+                    except Exception:
+                        pass
+                    browser = None
+        finally:
+            if browser is not None:
+                try:
+                    browser.close()
+                except Exception:
+                    pass
+
+browser_pool = BrowserPool(BROWSER_POOL_SIZE, BROWSER_MAX_PAGES)
+atexit.register(browser_pool.shutdown)
+
+# Lean render mode
+RENDER_MODES = ('full', 'lean')
+LEAN_BLOCKED_RESOURCE_TYPES = {'media', 'font', 'websocket', 'eventsource', 'manifest', 'texttrack'}
+LEAN_READY_TIMEOUT = 10000
+TRACKER_DOMAINS = (
+    'google-analytics.com', 'googletagmanager.com', 'googlesyndication.com', 'googleadservices.com',
+    'doubleclick.net', 'adservice.google.com', 'amazon-adsystem.com', 'adnxs.com', 'criteo.com',
+    'criteo.net', 'taboola.com', 'outbrain.com', 'facebook.net', 'scorecardresearch.com',
+    'chartbeat.com', 'chartbeat.net', 'hotjar.com', 'quantserve.com', 'smartadserver.com',
+    'pubmatic.com', 'rubiconproject.com', 'teads.tv', 'xiti.com', 'moatads.com'
+)
+
+def is_tracker_host(host):
+    host = host.lower()
+    return any(host == domain or host.endswith('.' + domain) for domain in TRACKER_DOMAINS)
+
+def is_same_site_host(host, page_host):
+    # www.example.com, example.com and static.example.com belong to the same site
+    host = (host or '').lower()
+    base = (page_host or '').lower()
+    if base.startswith('www.'):
+        base = base[4:]
+    return bool(base) and (host == base or host.endswith('.' + base))
+
+def setup_lean_routing(page, skipped_resources, block_stylesheets=False):
+    blocked_types = set(LEAN_BLOCKED_RESOURCE_TYPES)
+    if block_stylesheets:
+        blocked_types.add('stylesheet')
+    
+    def handle_route(route):
+        req = route.request
+        if req.resource_type in blocked_types:
+            reason = req.resource_type
+        elif is_tracker_host(urlparse(req.url).hostname or ''):
+            reason = 'tracker'
+        elif req.resource_type == 'document' and req.frame.parent_frame is not None \
+                and not is_same_site_host(urlparse(req.url).hostname, urlparse(page.main_frame.url).hostname):
+            # Only third-party iframes, same-site ones may hold the article images
+            reason = 'iframe'
+        else:
+            route.continue_()
+            return
+        skipped_resources[reason] = skipped_resources.get(reason, 0) + 1
+        route.abort()
+    
+    page.route('**/*', handle_route)
+
+def wait_for_images_ready(page):
+    # Readiness signal for lean mode: every <img> has finished loading or failed
+    from playwright.sync_api import TimeoutError as PlaywrightTimeout
+    try:
+        page.wait_for_function('''
+            () => Array.from(document.images).every(img => img.complete)
+        ''', timeout=LEAN_READY_TIMEOUT)
+    except PlaywrightTimeout:
+        logger.info("Images still loading after lean readiness timeout, continuing")
+
+# Headers that no longer match the body once requests has decoded it
+DOCUMENT_DROPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection'}
+
+def setup_document_fulfilment(page, document):
+    # Serves the main navigation from the HTML already downloaded by the
+    # static pass, subresources still go to the network
+    fulfilled = []
+    
+    def handle_route(route):
+        req = route.request
+        if not fulfilled and req.is_navigation_request() and req.frame == page.main_frame:
+            fulfilled.append(req.url)
+            route.fulfill(
+                status=document['status'],
+                headers={k: v for k, v in document['headers'].items() if k.lower() not in DOCUMENT_DROPPED_HEADERS},
+                body=document['body']
+            )
+            return
+        route.fallback()
+    
+    page.route('**/*', handle_route)
+
+def is_reusable_document(document):
+    if not document or document['status'] != 200:
+        return False
+    content_type = next((v for k, v in document['headers'].items() if k.lower() == 'content-type'), '')
+    return 'html' in content_type.lower()
+
+# Network image sniffing
+def capture_image_responses(page, responses):
+    # Keeps the image responses of the page so their bodies can be sniffed once it has rendered
+    def on_response(response):
+        if response.request.resource_type == 'image' and response.ok:
+            responses.append(response)
+    page.on('response', on_response)
+
+def sniff_image_responses(responses, cancel_event=None):
+    # Reads dimensions from the bytes the browser already downloaded, which also covers
+    # CSS backgrounds, hidden images and images that never reach the DOM
+    results = {}
+    for response in responses:
+        if cancel_event is not None and cancel_event.is_set():
+            break
+        if response.url in results:
+            continue
+        try:
+            body = response.body()
+        except Exception as e:
+            logger.debug(f"Could not read the body of {response.url}: {str(e)}")
+            continue
+        try:
+            width, height, image_format = parse_image_header(body)
+        except (ImageHeaderNeedMoreData, ValueError, struct.error):
+            try:
+                with Image.open(BytesIO(body)) as img:
+                    width, height = img.size
+                    image_format = img.format
+            except Exception:
+                continue
+        if not width or not height:
+            continue
+        results[response.url] = {
+            'width': width,
+            'height': height,
+            'format': image_format,
+            'byte_size': len(body)
+        }
+        image_cache.put(response.url, {
+            'width': width,
+            'height': height,
+            'format': image_format,
+            'etag': response.headers.get('etag'),
+            'content_length': len(body),
+            'method': 'network'
+        })
+    return results
+
+# In-page extraction
+DYNAMIC_LAZY_LOAD_BUDGET = int(os.environ.get('DYNAMIC_LAZY_LOAD_BUDGET', 5000))
+
+# Scrolls through the page in viewport steps so lazy images start loading, waits for
+# them within the time budget, then returns robots metas and image sizes in one payload
+DYNAMIC_EXTRACT_SCRIPT = '''
+    async (budget) => {
+        const started = performance.now();
+        const remaining = () => budget - (performance.now() - started);
+        const sleep = (ms) => new Promise(resolve => setTimeout(resolve, Math.max(ms, 0)));
+        
+        for (const img of document.images) {
+            if (img.loading === 'lazy') {
+                img.loading = 'eager';
+            }
+        }
+        const step = Math.max(window.innerHeight, 500);
+        for (let y = 0; y < document.documentElement.scrollHeight && remaining() > 0; y += step) {
+            window.scrollTo(0, y);
+            await sleep(Math.min(100, remaining()));
+        }
+        window.scrollTo(0, 0);
+        
+        const pending = Array.from(document.images).filter(img => !img.complete);
+        if (pending.length) {
+            await Promise.race([
+                Promise.all(pending.map(img => new Promise(resolve => {
+                    img.addEventListener('load', resolve, {once: true});
+                    img.addEventListener('error', resolve, {once: true});
+                }))),
+                sleep(remaining())
+            ]);
+        }
+        
+        return {
+            robots: Array.from(document.querySelectorAll('meta[name]'))
+                .map(meta => ({name: meta.name.trim().toLowerCase(), content: meta.content || ''}))
+                .filter(meta => meta.name === 'robots' || meta.name.startsWith('googlebot')),
+            images: Array.from(document.images).map(img => ({
+                src: img.currentSrc || img.src,
+                srcset: img.srcset || null,
+                w: img.naturalWidth || 0,
+                h: img.naturalHeight || 0
+            }))
+        };
+    }
+'''
+
+def run_dynamic_page_analysis(context, url, render_mode='full', block_stylesheets=False, document=None, timings=None,
+                              cancel_event=None):
+    results = {}
+    skipped_resources = {}
+    image_responses = []
+    page = context.new_page()
+    capture_image_responses(page, image_responses)
+    if render_mode == 'lean':
+        setup_lean_routing(page, skipped_resources, block_stylesheets)
+    # Registered last so it runs before the lean routing handler
+    if document:
+        setup_document_fulfilment(page, document)
+        url = document['url']
+    if timings is None:
+        timings = AnalysisTimings()
+    if cancel_event is None:
+        cancel_event = threading.Event()
+    
+    def check_cancelled():
+        # Playwright calls cannot be interrupted from another thread, so a cancellation
+        # is noticed between steps and the page is closed before the next one starts
+        if cancel_event.is_set():
+            page.close()
+            raise AnalysisCancelled()
+    
+    with timings.stage('page_goto'):
+        if render_mode == 'lean':
+            response = page.goto(url, timeout=30000, wait_until='domcontentloaded')
+            check_cancelled()
+            wait_for_images_ready(page)
+        else:
+            response = page.goto(url, timeout=30000, wait_until='networkidle')
+    if response and response.status in THROTTLE_STATUS_CODES:
+        raise HostThrottled(response.status, parse_retry_after(response.headers.get('retry-after')))
+    if response and not response.ok:
+        raise PageFetchError(response.status, response.url)
+    check_cancelled()
+    
+    with timings.stage('page_extract'):
+        page_data = page.evaluate(DYNAMIC_EXTRACT_SCRIPT, DYNAMIC_LAZY_LOAD_BUDGET)
+    robots_directives = parse_robots_directives(page_data['robots'], response.headers.get('x-robots-tag') if response else None)
+    
+    unresolved = 0
+    for img in page_data['images']:
+        if img['src'] and img['w'] and img['h']:
+            results[img['src']] = {
+                'width': img['w'],
+                'height': img['h'],
+                'static': False,
+                'dynamic': True,
+                'area': img['w'] * img['h']
+            }
+        elif img['src'] or img['srcset']:
+            unresolved += 1
+    if unresolved:
+        logger.info(f"{unresolved} images did not load within the lazy-loading budget")
+    check_cancelled()
+    
+    with timings.stage('network_sniff'):
+        sniffed_images = sniff_image_responses(image_responses, cancel_event)
+    check_cancelled()
+    timings.add_bytes('browser_images', sum(img['byte_size'] for img in sniffed_images.values()))
+    for img_url, sniffed in sniffed_images.items():
+        if img_url in results:
+            results[img_url]['byte_size'] = sniffed['byte_size']
+        else:
+            results[img_url] = {
+                'width': sniffed['width'],
+                'height': sniffed['height'],
+                'static': False,
+                'dynamic': True,
+                'area': sniffed['width'] * sniffed['height'],
+                'byte_size': sniffed['byte_size'],
+                'source': 'network'
+            }
+    return results, robots_directives, skipped_resources
+
+def analyze_dynamic_images(url, max_retries=3, render_mode='full', block_stylesheets=False, document=None,
+                           deadline=None, cancel_event=None, timings=None):
+    from playwright.sync_api import TimeoutError as PlaywrightTimeout
+    results = {}
+    robots_directives = parse_robots_directives([])
+    skipped_resources = {}
+    retries = 0
+    last_error = None
+    if cancel_event is None:
+        cancel_event = threading.Event()
+    if timings is None:
+        timings = AnalysisTimings()
+    queued_at = [0]
+    
+    def job(context):
+        # Time spent waiting for a browser, launching it and opening the context
+        timings.record('browser_acquire', time.monotonic() - queued_at[0])
+        # The job may have waited in the pool queue while the analysis was cancelled
+        if cancel_event.is_set():
+            raise AnalysisCancelled()
+        return run_dynamic_page_analysis(context, url, render_mode, block_stylesheets, document, timings, cancel_event)
+    context_options = {
+        'viewport': {'width': 4000, 'height': 4000},
+        'user_agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36'
+    }
+    
+    host = urlparse(url).netloc
+    while retries < max_retries:
+        timeout = DYNAMIC_JOB_TIMEOUT
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+        if cancel_event.is_set():
+            last_error = 'Cancelled'
+            break
+        if timeout <= 0 or (not document and timeout <= host_scheduler.pending_delay(host)):
+            last_error = 'Analysis deadline reached'
+            break
+        try:
+            logger.info(f"Dynamic analysis attempt {retries + 1}/{max_retries}")
+            # A reused document is served to the browser without contacting the host
+            if not document:
+                with timings.stage('host_wait'):
+                    host_scheduler.wait(host, deadline, cancel_event)
+            queued_at[0] = time.monotonic()
+            results, robots_directives, skipped_resources = browser_pool.run(
+                job,
+                context_options=context_options,
+                timeout=timeout
+            )
+            
+            # If we get here, the analysis was successful, exit the loop
+            host_scheduler.succeeded(host)
+            logger.info(f"Dynamic analysis successful on attempt {retries + 1}")
+            if skipped_resources:
+                logger.info(f"Lean render skipped resources: {skipped_resources}")
+            metrics.observe('dynamic_analysis_attempts', retries + 1)
+            return results, robots_directives, skipped_resources
+        except PageFetchError:
+            # Retrying would only fetch the same error page
+            raise
+        except PlaywrightTimeout:
+            last_error = f"Timeout loading page: {url}"
+            logger.warning(last_error)
+        except HostThrottled as e:
+            last_error = str(e)
+            host_scheduler.throttled(host, e.retry_after)
+        except AnalysisCancelled:
+            last_error = 'Cancelled'
+            break
+        except Exception as e:
+            last_error = str(e) or type(e).__name__
+            logger.error(f"Error in dynamic analysis: {last_error}")
+        
+        retries += 1
+        if retries < max_retries:
+            delay = max(backoff_delay(retries - 1), host_scheduler.pending_delay(host))
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                logger.info("Not enough time left for another dynamic analysis attempt")
+                break
+            logger.info(f"New attempt ({retries + 1}/{max_retries}) in {delay:.1f} seconds...")
+            cancel_event.wait(delay)
+    
+    if cancel_event.is_set():
+        logger.info("Dynamic analysis cancelled")
+    else:
+        logger.warning(f"Dynamic analysis failed after {retries} attempts. Last error: {last_error}")
+        metrics.observe('dynamic_analysis_attempts', retries)
+    return results, robots_directives, skipped_resources
+
+def merge_results(static_results, dynamic_results):
+    merged = {}
+    
+    all_urls = set(list(static_results.keys()) + list(dynamic_results.keys()))
+    
+    for url in all_urls:
+        static_data = static_results.get(url, {})
+        dynamic_data = dynamic_results.get(url, {})
+        
+        width = dynamic_data.get('width', static_data.get('width', 0))
+        height = dynamic_data.get('height', static_data.get('height', 0))
+        
+        if width > 0 and height > 0:  # Ignore invalid images
+            merged[url] = {
+                'url': url,
+                'width': width,
+                'height': height,
+                'static': url in static_results,
+                'dynamic': url in dynamic_results,
+                'area': width * height,
+                'bytes_read': static_data.get('bytes_read', 0),
+                'byte_size': dynamic_data.get('byte_size')
+            }
+    
+    # Sort by size and take the 3 largest images
+    sorted_images = sorted(merged.values(), key=lambda x: x['area'], reverse=True)[:3]
+    return sorted_images
+
+def get_document_validators(document):
+    headers = {k.lower(): v for k, v in (document or {}).get('headers', {}).items()}
+    return {
+        'etag': headers.get('etag'),
+        'last_modified': headers.get('last-modified')
+    }
+
+# Analysis orchestration
+ANALYSIS_DEADLINE = float(os.environ.get('ANALYSIS_DEADLINE', 120))
+ANALYSIS_MAX_WORKERS = int(os.environ.get('ANALYSIS_MAX_WORKERS', 16))
+
+analysis_executor = ThreadPoolExecutor(max_workers=ANALYSIS_MAX_WORKERS, thread_name_prefix='analysis')
+
+def analyze_url(url, render_mode='full', block_stylesheets=False, reuse_html=False, early_exit=False, progress=None,
+                static_only=False):
+    def report(message, percent):
+        if progress:
+            progress(message, percent)
+    
+    timings = AnalysisTimings()
+    started = time.monotonic()
+    try:
+        report('Analyzing static images...' if static_only else 'Analyzing static and dynamic images...', 10)
+        deadline = started + ANALYSIS_DEADLINE
+        cancel_static = threading.Event()
+        cancel_dynamic = threading.Event()
+        document_future = Future()
+        
+        def on_document(document):
+            if not document_future.done():
+                document_future.set_result(document)
+        
+        def run_static():
+            logger.info("Starting static image analysis")
+            try:
+                with timings.stage('static_total'):
+                    return analyze_static_images(
+                        url, deadline=deadline, cancel_event=cancel_static, early_exit=early_exit,
+                        on_document=on_document, keep_body=reuse_html, timings=timings
+                    )
+            finally:
+                on_document(None)
+        
+        def run_dynamic():
+            document = None
+            if reuse_html:
+                # The dynamic pass waits for the static HTML fetch only in this mode
+                try:
+                    document = document_future.result(timeout=max(deadline - time.monotonic(), 0))
+                except TimeoutError:
+                    pass
+                if not is_reusable_document(document):
+                    document = None
+            logger.info("Starting dynamic image analysis")
+            with timings.stage('dynamic_total'):
+                results, robots_directives, skipped_resources = analyze_dynamic_images(
+                    url, render_mode=render_mode, block_stylesheets=block_stylesheets,
+                    document=document, deadline=deadline, cancel_event=cancel_dynamic, timings=timings
+                )
+            return results, robots_directives, skipped_resources, document is not None
+        
+        # Both passes run concurrently, a pass proving compatibility cuts the other short
+        static_future = analysis_executor.submit(run_static)
+        cancel_events = {static_future: cancel_static}
+        pass_names = {static_future: 'static'}
+        dynamic_future = None
+        if not static_only:
+            # Static-only runs never start a browser
+            dynamic_future = analysis_executor.submit(run_dynamic)
+            cancel_events[dynamic_future] = cancel_dynamic
+            pass_names[dynamic_future] = 'dynamic'
+        outputs = {}
+        stopped_early = []
+        pending = set(pass_names)
+        while pending:
+            done, pending = wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                try:
+                    outputs[future] = future.result()
+                except PageFetchError:
+                    for event in cancel_events.values():
+                        event.set()
+                    raise
+                results, robots_directives = outputs[future][:2]
+                report(f"{pass_names[future].capitalize()} analysis complete", 50 if pending else 80)
+                if pending and proves_compatibility(results, robots_directives):
+                    for other in pending:
+                        logger.info(f"{pass_names[future].capitalize()} analysis proved compatibility, stopping {pass_names[other]} analysis")
+                        cancel_events[other].set()
+                        stopped_early.append(pass_names[other])
+                    pending = set()
+        
+        timed_out = [pass_names[future] for future in pending]
+        for future in pending:
+            cancel_events[future].set()
+        if timed_out:
+            logger.warning(f"Analysis deadline reached, unfinished passes: {timed_out}")
+        
+        no_directives = parse_robots_directives([])
+        static_results, static_directives, static_skipped, document = outputs.get(static_future, ({}, no_directives, {}, None))
+        dynamic_results, dynamic_directives, skipped_resources, reused_html = outputs.get(dynamic_future, ({}, no_directives, {}, False))
+        static_robots = static_directives['max_image_preview_large']
+        dynamic_robots = dynamic_directives['max_image_preview_large']
+        logger.info(f"Static results: {len(static_results)} images found, robots meta found: {static_robots}")
+        logger.info(f"Dynamic results: {len(dynamic_results)} images found, robots meta found: {dynamic_robots}")
+        
+        # Merge and sort results
+        report('Evaluating Google Discover compatibility...', 90)
+        with timings.stage('merge'):
+            largest_images = merge_results(static_results, dynamic_results)
+        logger.info(f"Results merged: {len(largest_images)} images retained")
+        
+        # Check for high resolution images
+        has_high_res = any(img['width'] >= DISCOVER_MIN_WIDTH for img in largest_images)
+        
+        # Check if dynamic analysis was successful
+        dynamic_analysis_success = len(dynamic_results) > 0
+        timings.record('total', time.monotonic() - started)
+        metrics.inc('analyses_total', outcome='success')
+        
+        return {
+            'url': url,
+            'robots_meta': {
+                'max_image_preview_large_found': static_robots or dynamic_robots,
+                'found_in_static': static_robots,
+                'found_in_dynamic': dynamic_robots,
+                'noindex': static_directives['noindex'] or dynamic_directives['noindex'],
+                'static_directives': static_directives,
+                'dynamic_directives': dynamic_directives
+            },
+            'discover_compatibility': {
+                'has_large_images': has_high_res,
+                'minimum_width_required': DISCOVER_MIN_WIDTH,
+                'compatible': has_high_res and (static_robots or dynamic_robots)
+            },
+            'largest_images': largest_images,
+            'analysis_info': {
+                'dynamic_analysis_success': dynamic_analysis_success,
+                'static_analysis_success': len(static_results) > 0,
+                'total_static_images': len(static_results),
+                'total_dynamic_images': len(dynamic_results),
+                'network_only_images': sum(1 for img in dynamic_results.values() if img.get('source') == 'network'),
+                'static_image_bytes_read': sum(img.get('bytes_read', 0) for img in static_results.values()),
+                'skipped_images': static_skipped,
+                'image_cache_hits': sum(1 for img in static_results.values() if img.get('probe_method') in ('cache', 'revalidated')),
+                'render_mode': render_mode,
+                'static_only': static_only,
+                'skipped_resources': skipped_resources,
+                'reused_static_html': reused_html,
+                'early_exit': early_exit,
+                'stopped_early': stopped_early,
+                'timed_out_passes': timed_out,
+                'validators': get_document_validators(document),
+                'fingerprint': (document or {}).get('fingerprint')
+            },
+            'timings': timings.as_dict()
+        }, None
+    except PageFetchError as e:
+        metrics.inc('analyses_total', outcome='error')
+        logger.warning(str(e))
+        return None, str(e)
+    except Exception as e:
+        metrics.inc('analyses_total', outcome='error')
+        logger.error(f"Error during analysis: {str(e)}")
+        logger.exception("Full stack trace:")
+        return None, str(e)
+
+# Admission control
+ANALYSIS_MEMORY_MB = int(os.environ.get('ANALYSIS_MEMORY_MB', 400))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 5))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 15))
+
+class ServerBusy(Exception):
+    pass
+
+def detect_memory_limit_mb():
+    # Container limit (cgroup v2, then v1), otherwise the physical memory
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value) // (1024 * 1024)
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def default_max_analyses():
+    # Each browser renders one page at a time, so one more analysis per browser can run
+    # its static pass meanwhile. The memory of the container is shared by the web workers.
+    limit = BROWSER_POOL_SIZE * 2
+    memory = detect_memory_limit_mb()
+    if memory:
+        workers = max(int(os.environ.get('WEB_CONCURRENCY', 1)), 1)
+        limit = min(limit, memory // workers // ANALYSIS_MEMORY_MB)
+    return max(limit, 1)
+
+MAX_CONCURRENT_ANALYSES = int(os.environ.get('MAX_CONCURRENT_ANALYSES', 0)) or default_max_analyses()
+
+class AdmissionController:
+    # Caps the analyses running at once in this process. Requests answered
+    # synchronously wait briefly for a slot, background work waits as long as needed.
+    # Once draining, no analysis is admitted and drain() waits for the running ones.
+    def __init__(self, limit):
+        self.limit = limit
+        self.slots = threading.BoundedSemaphore(limit)
+        self.idle = threading.Condition()
+        self.running = 0
+        self.draining_since = None
+        self.stats = {'admitted': 0, 'rejected': 0}
+
+    @property
+    def draining(self):
+        return self.draining_since is not None
+
+    def start_draining(self):
+        # Lock-free so it can be called from a signal handler
+        if self.draining_since is None:
+            self.draining_since = time.monotonic()
+
+    def draining_for(self):
+        return time.monotonic() - self.draining_since if self.draining else 0
+
+    @contextmanager
+    def slot(self, timeout=None):
+        if self.draining:
+            self.stats['rejected'] += 1
+            raise ServerBusy('Server is shutting down')
+        if not self.slots.acquire(timeout=timeout):
+            self.stats['rejected'] += 1
+            raise ServerBusy('Too many analyses in progress')
+        if self.draining:
+            self.slots.release()
+            self.stats['rejected'] += 1
+            raise ServerBusy('Server is shutting down')
+        with self.idle:
+            self.running += 1
+            self.stats['admitted'] += 1
+        try:
+            yield
+        finally:
+            with self.idle:
+                self.running -= 1
+                self.idle.notify_all()
+            self.slots.release()
+
+    def drain(self, timeout):
+        # Returns True once no analysis is running
+        self.start_draining()
+        with self.idle:
+            return self.idle.wait_for(lambda: self.running == 0, timeout)
+
+admission = AdmissionController(MAX_CONCURRENT_ANALYSES)
+
+# Result cache
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 1000))
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 3600))
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', '')
+RESULT_CACHE_DISK_TTL = float(os.environ.get('RESULT_CACHE_DISK_TTL', 86400))
+RESULT_CACHE_DISK_MAX_AGE = float(os.environ.get('RESULT_CACHE_DISK_MAX_AGE', 7 * 86400))
+RESULT_CACHE_DISK_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_DISK_MAX_ENTRIES', 10000))
+RESULT_CACHE_PRUNE_INTERVAL = 60
+
+class ResultCache:
+    # In-memory LRU with an optional on-disk layer, both with their own TTL.
+    # Expired entries are kept so they can be revalidated with their validators,
+    # on disk until they reach max_age or the directory holds more than max_disk_entries.
+    def __init__(self, size, ttl, disk_dir='', disk_ttl=0, disk_max_age=0, disk_max_entries=0):
+        self.size = size
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.disk_ttl = disk_ttl
+        self.disk_max_age = disk_max_age
+        self.disk_max_entries = disk_max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.prune_lock = threading.Lock()
+        self.last_prune = 0
+        self.stats = {'hit': 0, 'miss': 0, 'revalidated': 0, 'fingerprint': 0, 'bypass': 0, 'pruned': 0}
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f'{key}.json')
+
+    def get(self, key):
+        # Returns (entry, fresh) or (None, False)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                return entry, time.time() - entry['stored_at'] < self.ttl
+        if not self.disk_dir:
+            return None, False
+        try:
+            with open(self._disk_path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None, False
+        self._remember(key, entry)
+        return entry, time.time() - entry['stored_at'] < self.disk_ttl
+
+    def put(self, key, entry):
+        entry['stored_at'] = time.time()
+        self._remember(key, entry)
+        if self.disk_dir:
+            try:
+                os.makedirs(self.disk_dir, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(entry, f)
+                os.replace(tmp_path, self._disk_path(key))
+            except OSError as e:
+                logger.warning(f"Could not write result cache entry: {str(e)}")
+            self._prune_disk()
+
+    def _prune_disk(self):
+        # The first write after startup sweeps the directory, later ones at most once per
+        # interval. Oldest files go first, temporary files left by a crash are removed too.
+        now = time.time()
+        if now - self.last_prune < RESULT_CACHE_PRUNE_INTERVAL or not self.prune_lock.acquire(blocking=False):
+            return
+        try:
+            self.last_prune = now
+            files = []
+            with os.scandir(self.disk_dir) as it:
+                for item in it:
+                    if item.name.endswith(('.json', '.tmp')):
+                        try:
+                            files.append((item.stat().st_mtime, item.path))
+                        except OSError:
+                            pass
+            files.sort()
+            excess = max(len(files) - self.disk_max_entries, 0) if self.disk_max_entries else 0
+            removed = 0
+            for i, (mtime, path) in enumerate(files):
+                if path.endswith('.tmp'):
+                    expired = now - mtime > RESULT_CACHE_PRUNE_INTERVAL
+                else:
+                    expired = bool(self.disk_max_age) and now - mtime > self.disk_max_age
+                if i >= excess and not expired:
+                    continue
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+            if removed:
+                self.stats['pruned'] += removed
+                logger.info(f"Pruned {removed} result cache files from {self.disk_dir}")
+        except OSError as e:
+            logger.warning(f"Could not prune the result cache directory: {str(e)}")
+        finally:
+            self.prune_lock.release()
+
+    def _remember(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL, RESULT_CACHE_DIR, RESULT_CACHE_DISK_TTL,
+                           RESULT_CACHE_DISK_MAX_AGE, RESULT_CACHE_DISK_MAX_ENTRIES)
+
+# Fingerprint store
+FINGERPRINT_STORE_PATH = os.environ.get('FINGERPRINT_STORE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'fingerprints.sqlite3'))
+FINGERPRINT_STORE_MAX_ENTRIES = int(os.environ.get('FINGERPRINT_STORE_MAX_ENTRIES', 100000))
+
+class FingerprintStore:
+    # Keeps the last complete result of every analysis with its fingerprint in a SQLite
+    # file, shared by the server, the CLIs and later runs. Stored results are never served
+    # as is: they need a 304 or a matching fingerprint first.
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.evict_lock = threading.Lock()
+
+    def _connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS page_fingerprints (
+                    cache_key TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS page_fingerprints_last_used ON page_fingerprints (last_used)')
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        # Returns a result cache entry, or None
+        if not self.path:
+            return None
+        try:
+            conn = self._connect()
+            row = conn.execute('SELECT result, updated_at FROM page_fingerprints WHERE cache_key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE page_fingerprints SET last_used = ? WHERE cache_key = ?', (time.time(), key))
+            return {'result': json.loads(row[0]), 'stored_at': row[1]}
+        except (sqlite3.Error, ValueError) as e:
+            logger.warning(f"Fingerprint store lookup failed: {str(e)}")
+            return None
+
+    def put(self, key, result):
+        fingerprint = result['analysis_info'].get('fingerprint')
+        if not self.path or not fingerprint:
+            return
+        try:
+            now = time.time()
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO page_fingerprints VALUES (?, ?, ?, ?, ?, ?)',
+                (key, result['url'], fingerprint, json.dumps(result), now, now)
+            )
+            self._evict(conn)
+        except sqlite3.Error as e:
+            logger.warning(f"Fingerprint store write failed: {str(e)}")
+
+    def _evict(self, conn):
+        # Removes the least recently used tenth once the size bound is exceeded
+        if not self.evict_lock.acquire(blocking=False):
+            return
+        try:
+            count = conn.execute('SELECT COUNT(*) FROM page_fingerprints').fetchone()[0]
+            if count > self.max_entries:
+                excess = count - self.max_entries + self.max_entries // 10
+                conn.execute(
+                    'DELETE FROM page_fingerprints WHERE cache_key IN '
+                    '(SELECT cache_key FROM page_fingerprints ORDER BY last_used LIMIT ?)', (excess,)
+                )
+        finally:
+            self.evict_lock.release()
+
+fingerprint_store = FingerprintStore(FINGERPRINT_STORE_PATH, FINGERPRINT_STORE_MAX_ENTRIES)
+
+def result_cache_key(url, options):
+    return hashlib.sha256(json.dumps([url, options], sort_keys=True).encode()).hexdigest()
+
+def is_not_modified(url, validators):
+    headers = dict(REQUEST_HEADERS)
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    if len(headers) == len(REQUEST_HEADERS):
+        return False
+    try:
+        # Streamed so a 200 response body is never downloaded
+        response = scheduled_get(url, max_retries=0, headers=headers, timeout=10, verify=True, stream=True)
+        response.close()
+        return response.status_code == 304
+    except Exception as e:
+        logger.warning(f"Revalidation of {url} failed: {str(e)}")
+        return False
+
+def is_complete_result(results):
+    # Results cut short by a deadline or a failed dynamic pass are never reused
+    info = results['analysis_info']
+    if info['timed_out_passes'] or 'timed out' in info['skipped_images'].values():
+        return False
+    return info.get('static_only') or info['dynamic_analysis_success'] or 'dynamic' in info['stopped_early']
+
+def analyze_url_cached(url, bypass_cache=False, progress=None, admission_timeout=None, **options):
+    # Raises ServerBusy when no analysis slot frees up within admission_timeout
+    key = result_cache_key(url, options)
+    cache_status = 'bypass' if bypass_cache else 'miss'
+    if not bypass_cache:
+        # A served result gets the timings of this lookup, not those of the analysis that produced it
+        started = time.monotonic()
+        timings = AnalysisTimings()
+        with timings.stage('cache_lookup'):
+            entry, fresh = result_cache.get(key)
+            if entry is None:
+                # The store outlives the result cache, its entries are only served once confirmed
+                entry = fingerprint_store.get(key)
+        if entry and fresh:
+            cache_status = 'hit'
+        elif entry:
+            with timings.stage('revalidation'):
+                not_modified = is_not_modified(url, entry['result']['analysis_info'].get('validators', {}))
+            if not_modified:
+                entry['stored_at'] = time.time()
+                result_cache.put(key, entry)
+                cache_status = 'revalidated'
+            elif entry['result']['analysis_info'].get('fingerprint'):
+                with timings.stage('fingerprint_check'):
+                    matches = fetch_page_fingerprint(url) == entry['result']['analysis_info']['fingerprint']
+                if matches:
+                    # Same head and same images: the previous verdict still holds, the browser is not needed
+                    result_cache.put(key, entry)
+                    cache_status = 'fingerprint'
+        if cache_status != 'miss':
+            logger.info(f"Result cache {cache_status} for {url}")
+            result_cache.stats[cache_status] += 1
+            timings.record('total', time.monotonic() - started)
+            return dict(entry['result'], cache=cache_status, timings=timings.as_dict()), None
+    
+    with admission.slot(admission_timeout):
+        result_cache.stats[cache_status] += 1
+        results, error = analyze_url(url, progress=progress, **options)
+    if error:
+        return None, error
+    if is_complete_result(results):
+        result_cache.put(key, {'result': results})
+        fingerprint_store.put(key, results)
+    else:
+        logger.info(f"Incomplete result for {url} not cached")
+    return dict(results, cache=cache_status), None
+
+# Batch analysis
+BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', 4))
+BATCH_MAX_RUNTIME = float(os.environ.get('BATCH_MAX_RUNTIME', 3600))
+BATCH_MAX_URLS = int(os.environ.get('BATCH_MAX_URLS', 10000))
+BATCH_LOOKAHEAD = int(os.environ.get('BATCH_LOOKAHEAD', 100))
+
+def next_batch_url(pending, running_hosts):
+    # Picks the next URL from a host that is neither paused nor busy, so a throttled or
+    # slow host does not hold the whole batch back. Hosts are otherwise served in turn.
+    host = min(pending, key=lambda h: (host_scheduler.pending_delay(h) > 0, running_hosts.get(h, 0)))
+    urls = pending[host]
+    url = urls.popleft()
+    if urls:
+        pending.move_to_end(host)
+    else:
+        del pending[host]
+    return host, url
+
+def run_batch(urls, options, concurrency, max_runtime, max_urls=BATCH_MAX_URLS):
+    # Yields one result dict per URL as soon as it is ready
+    deadline = time.monotonic() + max_runtime
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch')
+    url_iter = iter(urls)
+    in_flight = {}
+    # URLs read ahead of time, grouped by host
+    pending = OrderedDict()
+    buffered = 0
+    running_hosts = {}
+    counts = {'total': 0, 'completed': 0, 'errors': 0, 'timed_out': 0}
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and buffered < max(BATCH_LOOKAHEAD, concurrency) and time.monotonic() < deadline:
+                raw_url = next(url_iter, None)
+                if raw_url is None:
+                    exhausted = True
+                    break
+                counts['total'] += 1
+                if counts['total'] > max_urls:
+                    counts['total'] -= 1
+                    exhausted = True
+                    logger.warning(f"Batch truncated to {max_urls} URLs")
+                    break
+                url = clean_url(raw_url)
+                if not is_valid_url(url):
+                    counts['errors'] += 1
+                    yield {'url': url, 'error': 'Invalid URL format'}
+                    continue
+                pending.setdefault(urlparse(url).netloc, deque()).append(url)
+                buffered += 1
+            
+            while pending and len(in_flight) < concurrency and time.monotonic() < deadline:
+                host, url = next_batch_url(pending, running_hosts)
+                buffered -= 1
+                running_hosts[host] = running_hosts.get(host, 0) + 1
+                in_flight[executor.submit(analyze_url_cached, url, **options)] = url
+            
+            if not in_flight:
+                if (exhausted and not pending) or time.monotonic() >= deadline:
+                    break
+                continue
+            
+            done, _ = wait(in_flight, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                url = in_flight.pop(future)
+                host = urlparse(url).netloc
+                running_hosts[host] -= 1
+                if not running_hosts[host]:
+                    del running_hosts[host]
+                try:
+                    results, error = future.result()
+                except ServerBusy as e:
+                    results, error = None, str(e)
+                if error:
+                    counts['errors'] += 1
+                    yield {'url': url, 'error': error}
+                else:
+                    counts['completed'] += 1
+                    yield results
+        
+        # Batch runtime exceeded: report what was still running or queued
+        for url in in_flight.values():
+            counts['timed_out'] += 1
+            yield {'url': url, 'error': 'Batch runtime exceeded'}
+        for host_urls in pending.values():
+            for url in host_urls:
+                counts['timed_out'] += 1
+                yield {'url': url, 'error': 'Batch runtime exceeded'}
+        if not exhausted:
+            for raw_url in url_iter:
+                if counts['total'] >= max_urls:
+                    break
+                counts['total'] += 1
+                counts['timed_out'] += 1
+                yield {'url': clean_url(raw_url), 'error': 'Batch runtime exceeded'}
+        yield {'batch': counts}
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# Site crawl
+CRAWL_STATE_PATH = os.environ.get('CRAWL_STATE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'crawl.sqlite3'))
+CRAWL_MAX_URLS = int(os.environ.get('CRAWL_MAX_URLS', 100000))
+CRAWL_MAX_SITEMAP_DEPTH = 3
+FEED_ENTRY_TAGS = {'url', 'sitemap', 'item', 'entry'}
+FEED_DATE_TAGS = ('lastmod', 'updated', 'pubDate', 'date', 'published')
+
+def local_tag(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def parse_feed_entry(elem):
+    # Returns (url, lastmod) for a sitemap <url>/<sitemap>, RSS <item> or Atom <entry>
+    url = None
+    lastmod = None
+    for child in elem:
+        tag = local_tag(child.tag)
+        if tag == 'loc' and child.text:
+            url = child.text.strip()
+        elif tag == 'link' and url is None:
+            if child.get('href') and child.get('rel', 'alternate') == 'alternate':
+                url = child.get('href').strip()
+            elif child.text and child.text.strip():
+                url = child.text.strip()
+        elif tag in FEED_DATE_TAGS and lastmod is None and child.text:
+            lastmod = child.text.strip()
+    return url, lastmod
+
+def iter_feed_entries(feed_url, depth=0):
+    # Stream-parses a sitemap, sitemap index, RSS or Atom feed and yields
+    # (url, lastmod) pairs, dropping every parsed element straight away
+    response = scheduled_get(feed_url, headers=REQUEST_HEADERS, timeout=30, verify=True, stream=True)
+    child_sitemaps = []
+    try:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        source = response.raw
+        if urlparse(feed_url).path.endswith('.gz'):
+            source = gzip.GzipFile(fileobj=source)
+        stack = []
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                stack.append(elem)
+                continue
+            stack.pop()
+            tag = local_tag(elem.tag)
+            if tag not in FEED_ENTRY_TAGS:
+                continue
+            url, lastmod = parse_feed_entry(elem)
+            elem.clear()
+            if stack:
+                stack[-1].remove(elem)
+            if not url:
+                continue
+            if tag == 'sitemap':
+                child_sitemaps.append(url)
+            else:
+                yield url, lastmod
+    finally:
+        response.close()
+    
+    for child_url in child_sitemaps:
+        if depth >= CRAWL_MAX_SITEMAP_DEPTH:
+            logger.warning(f"Sitemap {child_url} ignored, maximum depth reached")
+            continue
+        try:
+            yield from iter_feed_entries(child_url, depth + 1)
+        except Exception as e:
+            logger.error(f"Error reading sitemap {child_url}: {str(e)}")
+
+class CrawlState:
+    # Remembers the lastmod and verdict of every crawled page in a SQLite file
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS crawl_pages (
+                    url TEXT PRIMARY KEY,
+                    lastmod TEXT,
+                    compatible INTEGER,
+                    error TEXT,
+                    analyzed_at REAL NOT NULL
+                )
+            ''')
+            self.local.conn = conn
+        return conn
+
+    def get(self, url):
+        row = self._connect().execute('SELECT lastmod, compatible, error FROM crawl_pages WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return {'lastmod': row[0], 'compatible': bool(row[1]), 'error': row[2]}
+
+    def put(self, url, lastmod, compatible, error=None):
+        self._connect().execute(
+            'INSERT OR REPLACE INTO crawl_pages VALUES (?, ?, ?, ?, ?)',
+            (url, lastmod, int(bool(compatible)), error, time.time())
+        )
+
+def url_section(url):
+    segments = [segment for segment in urlparse(url).path.split('/') if segment]
+    return '/' + segments[0] if len(segments) > 1 else '/'
+
+def crawl_site(source_url, options, concurrency=BATCH_MAX_CONCURRENCY, max_runtime=BATCH_MAX_RUNTIME,
+               max_urls=CRAWL_MAX_URLS, force=False, state_path=CRAWL_STATE_PATH):
+    # Yields one event per page, then a final {'report': ...} aggregated per section
+    state = CrawlState(state_path)
+    sections = {}
+    lastmods = {}
+    skipped_unchanged = [0]
+    
+    def count(url, key):
+        section = sections.setdefault(url_section(url), {'compatible': 0, 'not_compatible': 0, 'errors': 0, 'unchanged': 0})
+        section[key] += 1
+    
+    def pending_urls():
+        seen = set()
+        for url, lastmod in iter_feed_entries(source_url):
+            url = clean_url(url)
+            if url in seen:
+                continue
+            seen.add(url)
+            previous = None if force else state.get(url)
+            if previous and lastmod and previous['lastmod'] == lastmod and not previous['error']:
+                skipped_unchanged[0] += 1
+                count(url, 'unchanged')
+                count(url, 'compatible' if previous['compatible'] else 'not_compatible')
+                continue
+            lastmods[url] = lastmod
+            yield url
+    
+    # Unchanged pages are only counted, their previous verdict goes into the report
+    batch_counts = {}
+    try:
+        for line in run_batch(pending_urls(), options, concurrency, max_runtime, max_urls=max_urls):
+            if 'batch' in line:
+                batch_counts = line['batch']
+                continue
+            url = line['url']
+            lastmod = lastmods.pop(url, None)
+            if 'error' in line:
+                count(url, 'errors')
+                state.put(url, lastmod, False, line['error'])
+                yield {'url': url, 'status': 'error', 'error': line['error']}
+                continue
+            compatible = line['discover_compatibility']['compatible']
+            count(url, 'compatible' if compatible else 'not_compatible')
+            state.put(url, lastmod, compatible)
+            yield {'url': url, 'status': 'analyzed', 'compatible': compatible, 'cache': line.get('cache')}
+    except Exception as e:
+        logger.error(f"Error crawling {source_url}: {str(e)}")
+        yield {'error': f"Error reading feed: {str(e)}"}
+    
+    totals = {'compatible': 0, 'not_compatible': 0, 'errors': 0, 'unchanged': 0}
+    for section in sections.values():
+        for key in totals:
+            totals[key] += section[key]
+    yield {'report': {
+        'source': source_url,
+        'analyzed': batch_counts.get('completed', 0),
+        'timed_out': batch_counts.get('timed_out', 0),
+        'unchanged': skipped_unchanged[0],
+        'totals': totals,
+        'sections': dict(sorted(sections.items()))
+    }}
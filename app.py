@@ -1,312 +1,45 @@
-from flask import Flask, request, jsonify, render_template_string
-import requests
-from bs4 import BeautifulSoup
-from PIL import Image
-from io import BytesIO
-from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeout
+from flask import Flask, request, jsonify, render_template_string, Response, stream_with_context
 import tempfile
+import fcntl
 import os
-import logging
-from urllib.parse import urljoin, urlparse
 import json
-from logging.handlers import RotatingFileHandler
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import uuid
+import re
 
-# Logging configuration
-log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, 'app.log')
-
-logging.basicConfig(level=logging.INFO,
-                   format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
-
-# Add handler to write to a file
-file_handler = RotatingFileHandler(log_file, maxBytes=10485760, backupCount=5)
-file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-logger.addHandler(file_handler)
+from analyzer import (
+    logger, configure_logging, is_valid_url, clean_url, metrics, http_client, host_scheduler, image_cache, browser_pool,
+    RENDER_MODES, ADMISSION_QUEUE_TIMEOUT, ADMISSION_RETRY_AFTER, ServerBusy, admission,
+    result_cache, analyze_url_cached, BATCH_MAX_URLS, BATCH_MAX_CONCURRENCY, BATCH_MAX_RUNTIME,
+    run_batch, CRAWL_MAX_URLS, crawl_site
+)
 
-# Add handler for console
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-logger.addHandler(console_handler)
+# Logging configuration
+configure_logging(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'app.log'))
 
 app = Flask(__name__)
 
-def is_valid_url(url):
-    try:
-        # Clean up URL first
-        url = url.strip()
-        # Remove any accidental URL prefixes
-        if url.startswith('examphttps://'):
-            url = url.replace('examphttps://', 'https://')
-        # Remove any trailing "le.com" that might be mistakenly added
-        if url.endswith('/le.com'):
-            url = url[:-7]
-            
-        # Ensure URL starts with http:// or https://
-        if not url.startswith(('http://', 'https://')):
-            return False
-            
-        # Additional security checks
-        parsed = urlparse(url)
-        # Check for basic URL structure
-        if not all([parsed.scheme, parsed.netloc]):
-            return False
-        # Ensure scheme is http or https
-        if parsed.scheme not in ['http', 'https']:
-            return False
-        # Check for common injection patterns
-        dangerous_patterns = ['javascript:', 'data:', 'vbscript:', '<script', '-->']
-        if any(pattern in url.lower() for pattern in dangerous_patterns):
-            return False
-            
-        return True
-    except:
-        return False
+def busy_response(error):
+    return jsonify({'error': str(error)}), 503, {'Retry-After': str(ADMISSION_RETRY_AFTER)}
 
-def check_robots_meta(soup):
-    try:
-        meta_robots_list = [
-            soup.find('meta', attrs={'name': lambda x: x and x.lower() == 'robots'}),
-            soup.find('meta', attrs={'name': 'ROBOTS'}),
-            soup.find('meta', attrs={'name': 'Robots'}),
-            soup.find('meta', content=lambda x: x and 'max-image-preview:large' in x.lower())
-        ]
-        
-        for meta_robots in meta_robots_list:
-            if meta_robots:
-                content = meta_robots.get('content', '').lower()
-                content_parts = [part.strip() for part in content.split(',')]
-                normalized_content = ','.join(content_parts)
-                normalized_content = normalized_content.replace(' : ', ':').replace(': ', ':').replace(' :', ':')
-                if 'max-image-preview:large' in normalized_content:
-                    return True
-        
-        html_content = str(soup)
-        if 'max-image-preview:large' in html_content.lower():
-            return True
-            
-        return False
-    except Exception as e:
-        logger.error(f"Error checking robots meta: {str(e)}")
-        return False
+def parse_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
 
-def analyze_static_images(url):
-    results = {}
-    robots_meta_found = False
-    try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Connection': 'keep-alive',
-        }
-        
-        response = requests.get(url, headers=headers, timeout=30, verify=True)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        robots_meta_found = check_robots_meta(soup)
-        
-        for img in soup.find_all('img'):
-            img_url = img.get('src', '')
-            if not img_url:
-                continue
-                
-            if not img_url.startswith(('http://', 'https://')):
-                if img_url.startswith('//'):
-                    img_url = 'https:' + img_url
-                else:
-                    img_url = urljoin(url, img_url)
-            
-            try:
-                img_response = requests.get(img_url, headers=headers, timeout=10, verify=True)
-                img_response.raise_for_status()
-                
-                img_data = Image.open(BytesIO(img_response.content))
-                results[img_url] = {
-                    'width': img_data.width,
-                    'height': img_data.height,
-                    'static': True,
-                    'dynamic': False,
-                    'area': img_data.width * img_data.height
-                }
-            except Exception as e:
-                logger.warning(f"Error processing image {img_url}: {str(e)}")
-                continue
-    except Exception as e:
-        logger.error(f"Error in static analysis: {str(e)}")
-    return results, robots_meta_found
-
-def analyze_dynamic_images(url, max_retries=3):
-    results = {}
-    robots_meta_found = False
-    retries = 0
-    last_error = None
-    
-    while retries < max_retries:
-        try:
-            logger.info(f"Dynamic analysis attempt {retries + 1}/{max_retries}")
-            with sync_playwright() as p:
-                browser = p.chromium.launch(
-                    args=['--no-sandbox', '--disable-setuid-sandbox']
-                )
-                context = browser.new_context(
-                    viewport={'width': 4000, 'height': 4000},
-                    user_agent='Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36'
-                )
-                page = context.new_page()
-                try:
-                    page.goto(url, timeout=30000, wait_until='networkidle')
-                    
-                    robots_meta_found = page.evaluate('''
-                        () => {
-                            try {
-                                const robotsMeta = document.querySelector('meta[name="robots"], meta[name="ROBOTS"], meta[name="Robots"]');
-                                if (robotsMeta) {
-                                    const content = robotsMeta.content.toLowerCase();
-                                    return content.includes('max-image-preview:large');
-                                }
-                                
-                                const allMetas = document.getElementsByTagName('meta');
-                                for (const meta of allMetas) {
-                                    const content = meta.content ? meta.content.toLowerCase() : '';
-                                    if (content.includes('max-image-preview:large')) {
-                                        return true;
-                                    }
-                                }
-                                
-                                const htmlContent = document.documentElement.innerHTML.toLowerCase();
-                                return htmlContent.includes('max-image-preview:large');
-                            } catch (e) {
-                                console.error('Error checking robots meta:', e);
-                                return false;
-                            }
-                        }
-                    ''')
-                    
-                    images = page.evaluate('''
-                        () => {
-                            try {
-                                const images = document.getElementsByTagName('img');
-                                return Array.from(images).map(img => ({
-                                    src: img.src,
-                                    width: img.naturalWidth || 0,
-                                    height: img.naturalHeight || 0
-                                }));
-                            } catch (e) {
-                                console.error('Error getting images:', e);
-                                return [];
-                            }
-                        }
-                    ''')
-                    
-                    for img in images:
-                        if img['src'] and img['width'] and img['height']:
-                            results[img['src']] = {
-                                'width': img['width'],
-                                'height': img['height'],
-                                'static': False,
-                                'dynamic': True,
-                                'area': img['width'] * img['height']
-                            }
-                    
-                    # If we get here, the analysis was successful, exit the loop
-                    logger.info(f"Dynamic analysis successful on attempt {retries + 1}")
-                    return results, robots_meta_found
-                    
-                except PlaywrightTimeout:
-                    last_error = f"Timeout loading page: {url}"
-                    logger.warning(last_error)
-                except Exception as e:
-                    last_error = str(e)
-                    logger.error(f"Error in dynamic analysis: {last_error}")
-                finally:
-                    browser.close()
-        except Exception as e:
-            last_error = str(e)
-            logger.error(f"Error initializing Playwright: {last_error}")
-        
-        retries += 1
-        if retries < max_retries:
-            logger.info(f"New attempt ({retries + 1}/{max_retries}) in 2 seconds...")
-            time.sleep(2)
-    
-    logger.warning(f"Dynamic analysis failed after {max_retries} attempts. Last error: {last_error}")
-    return results, robots_meta_found
-
-def merge_results(static_results, dynamic_results):
-    merged = {}
-    
-    all_urls = set(list(static_results.keys()) + list(dynamic_results.keys()))
-    
-    for url in all_urls:
-        static_data = static_results.get(url, {})
-        dynamic_data = dynamic_results.get(url, {})
-        
-        width = dynamic_data.get('width', static_data.get('width', 0))
-        height = dynamic_data.get('height', static_data.get('height', 0))
-        
-        if width > 0 and height > 0:  # Ignore invalid images
-            merged[url] = {
-                'url': url,
-                'width': width,
-                'height': height,
-                'static': url in static_results,
-                'dynamic': url in dynamic_results,
-                'area': width * height
-            }
-    
-    # Sort by size and take the 3 largest images
-    sorted_images = sorted(merged.values(), key=lambda x: x['area'], reverse=True)[:3]
-    return sorted_images
-
-def analyze_url(url):
-    try:
-        # Analyze images
-        logger.info("Starting static image analysis")
-        static_results, static_robots = analyze_static_images(url)
-        logger.info(f"Static results: {len(static_results)} images found, robots meta found: {static_robots}")
-        
-        logger.info("Starting dynamic image analysis")
-        dynamic_results, dynamic_robots = analyze_dynamic_images(url)
-        logger.info(f"Dynamic results: {len(dynamic_results)} images found, robots meta found: {dynamic_robots}")
-        
-        # Merge and sort results
-        largest_images = merge_results(static_results, dynamic_results)
-        logger.info(f"Results merged: {len(largest_images)} images retained")
-        
-        # Check for high resolution images
-        has_high_res = any(img['width'] >= 1200 for img in largest_images)
-        
-        # Check if dynamic analysis was successful
-        dynamic_analysis_success = len(dynamic_results) > 0
-        
-        return {
-            'url': url,
-            'robots_meta': {
-                'max_image_preview_large_found': static_robots or dynamic_robots,
-                'found_in_static': static_robots,
-                'found_in_dynamic': dynamic_robots
-            },
-            'discover_compatibility': {
-                'has_large_images': has_high_res,
-                'minimum_width_required': 1200,
-                'compatible': has_high_res and (static_robots or dynamic_robots)
-            },
-            'largest_images': largest_images,
-            'analysis_info': {
-                'dynamic_analysis_success': dynamic_analysis_success,
-                'static_analysis_success': len(static_results) > 0,
-                'total_static_images': len(static_results),
-                'total_dynamic_images': len(dynamic_results)
-            }
-        }, None
-    except Exception as e:
-        logger.error(f"Error during analysis: {str(e)}")
-        logger.exception("Full stack trace:")
-        return None, str(e)
+def parse_analysis_options(data):
+    render_mode = data.get('render_mode', 'full')
+    if render_mode not in RENDER_MODES:
+        return None, f"render_mode must be one of: {', '.join(RENDER_MODES)}"
+    return {
+        'render_mode': render_mode,
+        'block_stylesheets': parse_bool(data.get('block_stylesheets', False)),
+        'reuse_html': parse_bool(data.get('reuse_html', False)),
+        'early_exit': parse_bool(data.get('early_exit', False)),
+        'bypass_cache': parse_bool(data.get('bypass_cache', False))
+    }, None
 
 @app.route('/api/analyze', methods=['POST'])
 def api_analyze():
@@ -326,17 +59,22 @@ def api_analyze():
         return jsonify({'error': 'URL is required'}), 400
         
     # Clean up URL before validation
-    url = url.strip()
-    if url.startswith('examphttps://'):
-        url = url.replace('examphttps://', 'https://')
-    if url.endswith('/le.com'):
-        url = url[:-7]
+    url = clean_url(url)
         
     if not is_valid_url(url):
         logger.error(f"Invalid URL format: {url}")
         return jsonify({'error': 'Invalid URL format'}), 400
     
-    results, error = analyze_url(url)
+    options, error = parse_analysis_options(data)
+    if error:
+        logger.error(error)
+        return jsonify({'error': error}), 400
+    
+    try:
+        results, error = analyze_url_cached(url, admission_timeout=ADMISSION_QUEUE_TIMEOUT, **options)
+    except ServerBusy as e:
+        logger.warning(f"Analysis of {url} rejected: {str(e)}")
+        return busy_response(e)
     
     if error:
         return jsonify({
@@ -348,6 +86,334 @@ def api_analyze():
     logger.info("Analysis completed successfully")
     return jsonify(results)
 
+def iter_uploaded_urls(file_storage):
+    # One URL per line, read lazily so large uploads are never fully decoded
+    for line in file_storage.stream:
+        line = line.decode('utf-8', errors='replace').strip()
+        if line and not line.startswith('#'):
+            yield line
+
+@app.route('/api/analyze/batch', methods=['POST'])
+def api_analyze_batch():
+    logger.info("New batch analysis request received via API")
+    if admission.draining:
+        return busy_response('Server is shutting down')
+    
+    if request.is_json:
+        data = request.get_json()
+        urls = data.get('urls')
+        if not isinstance(urls, list) or not urls:
+            logger.error("URL list missing in batch request")
+            return jsonify({'error': 'urls must be a non-empty list'}), 400
+        if len(urls) > BATCH_MAX_URLS:
+            return jsonify({'error': f"A batch accepts at most {BATCH_MAX_URLS} URLs"}), 400
+        urls = [str(url) for url in urls]
+    elif 'file' in request.files:
+        data = request.form.to_dict()
+        urls = iter_uploaded_urls(request.files['file'])
+    else:
+        logger.error("Batch request without URL list or file")
+        return jsonify({'error': 'Send a JSON body with urls or upload a file with one URL per line'}), 400
+    
+    options, error = parse_analysis_options(data)
+    if error:
+        logger.error(error)
+        return jsonify({'error': error}), 400
+    
+    try:
+        concurrency = min(max(int(data.get('concurrency', BATCH_MAX_CONCURRENCY)), 1), BATCH_MAX_CONCURRENCY)
+        max_runtime = min(max(float(data.get('max_runtime', BATCH_MAX_RUNTIME)), 1), BATCH_MAX_RUNTIME)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'concurrency and max_runtime must be numbers'}), 400
+    
+    logger.info(f"Batch started with concurrency {concurrency} and max runtime {max_runtime}s")
+    
+    def generate():
+        for line in run_batch(urls, options, concurrency, max_runtime):
+            yield json.dumps(line) + '\n'
+        logger.info("Batch analysis completed")
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/crawl', methods=['POST'])
+def api_crawl():
+    logger.info("New crawl request received via API")
+    if admission.draining:
+        return busy_response('Server is shutting down')
+    
+    if not request.is_json:
+        logger.error("Request is not in JSON format")
+        return jsonify({'error': 'Content-Type must be application/json'}), 400
+    
+    data = request.get_json()
+    source = data.get('source')
+    if not source:
+        logger.error("Feed URL missing in request")
+        return jsonify({'error': 'source (sitemap or feed URL) is required'}), 400
+    
+    source = clean_url(source)
+    if not is_valid_url(source):
+        logger.error(f"Invalid URL format: {source}")
+        return jsonify({'error': 'Invalid URL format'}), 400
+    
+    options, error = parse_analysis_options(data)
+    if error:
+        logger.error(error)
+        return jsonify({'error': error}), 400
+    
+    try:
+        concurrency = min(max(int(data.get('concurrency', BATCH_MAX_CONCURRENCY)), 1), BATCH_MAX_CONCURRENCY)
+        max_runtime = min(max(float(data.get('max_runtime', BATCH_MAX_RUNTIME)), 1), BATCH_MAX_RUNTIME)
+        max_urls = min(max(int(data.get('max_urls', CRAWL_MAX_URLS)), 1), CRAWL_MAX_URLS)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'concurrency, max_runtime and max_urls must be numbers'}), 400
+    
+    logger.info(f"Crawl of {source} started with concurrency {concurrency}")
+    
+    def generate():
+        for line in crawl_site(source, options, concurrency, max_runtime, max_urls, force=parse_bool(data.get('force', False))):
+            yield json.dumps(line) + '\n'
+        logger.info(f"Crawl of {source} completed")
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# Background jobs
+JOB_STORE_DIR = os.environ.get('JOB_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs'))
+JOB_MAX_WORKERS = int(os.environ.get('JOB_MAX_WORKERS', 2))
+JOB_RETENTION = float(os.environ.get('JOB_RETENTION', 7 * 24 * 3600))
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+job_executor = ThreadPoolExecutor(max_workers=JOB_MAX_WORKERS, thread_name_prefix='job')
+job_store_lock = threading.Lock()
+job_claims = {}
+
+def job_path(job_id):
+    return os.path.join(JOB_STORE_DIR, f'{job_id}.json')
+
+def save_job(job):
+    # Written to a temporary file first so a crash never leaves a truncated job
+    job['updated_at'] = time.time()
+    with job_store_lock:
+        os.makedirs(JOB_STORE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=JOB_STORE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, job_path(job['id']))
+
+def claim_job(job_id):
+    # Every worker process shares JOB_STORE_DIR. The process holding the lock on
+    # the job's lock file owns it, and the lock is released when that process dies
+    os.makedirs(JOB_STORE_DIR, exist_ok=True)
+    fd = os.open(os.path.join(JOB_STORE_DIR, f'{job_id}.lock'), os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    with job_store_lock:
+        job_claims[job_id] = fd
+    return True
+
+def release_job(job_id):
+    with job_store_lock:
+        fd = job_claims.pop(job_id, None)
+    if fd is not None:
+        os.close(fd)
+
+def load_job(job_id):
+    if not JOB_ID_PATTERN.match(job_id):
+        return None
+    try:
+        with open(job_path(job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def send_job_callback(job):
+    try:
+        response = http_client.post(job['callback_url'], json=job, timeout=10)
+        response.raise_for_status()
+        return 'delivered'
+    except Exception as e:
+        logger.warning(f"Callback for job {job['id']} to {job['callback_url']} failed: {str(e)}")
+        return f'failed: {str(e)}'
+
+def run_job(job_id):
+    try:
+        execute_job(job_id)
+    finally:
+        release_job(job_id)
+
+def execute_job(job_id):
+    job = load_job(job_id)
+    if not job:
+        logger.error(f"Job {job_id} not found in store")
+        return
+    logger.info(f"Running job {job_id} for {job['url']}")
+    job['status'] = 'running'
+    save_job(job)
+    
+    def progress(message, percent):
+        job['progress'] = {'message': message, 'percent': percent}
+        save_job(job)
+    
+    try:
+        results, error = analyze_url_cached(job['url'], progress=progress, **job['options'])
+    except ServerBusy:
+        # Shutting down: the job stays queued on disk and is resumed by the next process
+        job['status'] = 'queued'
+        job['progress'] = {'message': 'Waiting for a worker...', 'percent': 0}
+        save_job(job)
+        return
+    except Exception as e:
+        results, error = None, str(e)
+    job['status'] = 'failed' if error else 'done'
+    job['result'] = results
+    job['error'] = error
+    job['progress'] = {'message': 'Analysis failed' if error else 'Analysis complete', 'percent': 100}
+    save_job(job)
+    if job.get('callback_url'):
+        job['callback_status'] = send_job_callback(job)
+        save_job(job)
+    logger.info(f"Job {job_id} finished with status {job['status']}")
+
+def submit_job(url, options, callback_url=None):
+    job = {
+        'id': uuid.uuid4().hex,
+        'url': url,
+        'options': options,
+        'callback_url': callback_url,
+        'status': 'queued',
+        'progress': {'message': 'Waiting for a worker...', 'percent': 0},
+        'result': None,
+        'error': None,
+        'created_at': time.time()
+    }
+    claim_job(job['id'])
+    save_job(job)
+    job_executor.submit(run_job, job['id'])
+    return job
+
+def resume_jobs():
+    # Requeues jobs interrupted by a restart and removes expired ones
+    if not os.path.isdir(JOB_STORE_DIR):
+        return
+    resumed = 0
+    for filename in sorted(os.listdir(JOB_STORE_DIR)):
+        if not filename.endswith('.json'):
+            continue
+        job = load_job(filename[:-5])
+        if not job:
+            continue
+        if job['status'] in ('queued', 'running'):
+            # Jobs held by another live worker process are left to it
+            if not claim_job(job['id']):
+                continue
+            job = load_job(job['id'])
+            if not job or job['status'] not in ('queued', 'running'):
+                release_job(filename[:-5])
+                continue
+            job['status'] = 'queued'
+            save_job(job)
+            job_executor.submit(run_job, job['id'])
+            resumed += 1
+        elif time.time() - job.get('updated_at', 0) > JOB_RETENTION:
+            os.remove(job_path(job['id']))
+            try:
+                os.remove(os.path.join(JOB_STORE_DIR, f"{job['id']}.lock"))
+            except OSError:
+                pass
+    if resumed:
+        logger.info(f"Resumed {resumed} interrupted jobs")
+
+@app.route('/api/jobs', methods=['POST'])
+def api_create_job():
+    logger.info("New analysis job received via API")
+    if admission.draining:
+        return busy_response('Server is shutting down')
+    
+    if not request.is_json:
+        logger.error("Request is not in JSON format")
+        return jsonify({'error': 'Content-Type must be application/json'}), 400
+    
+    data = request.get_json()
+    url = data.get('url')
+    if not url:
+        logger.error("URL missing in request")
+        return jsonify({'error': 'URL is required'}), 400
+    
+    url = clean_url(url)
+    if not is_valid_url(url):
+        logger.error(f"Invalid URL format: {url}")
+        return jsonify({'error': 'Invalid URL format'}), 400
+    
+    callback_url = data.get('callback_url')
+    if callback_url and not is_valid_url(callback_url):
+        logger.error(f"Invalid callback URL: {callback_url}")
+        return jsonify({'error': 'Invalid callback_url format'}), 400
+    
+    options, error = parse_analysis_options(data)
+    if error:
+        logger.error(error)
+        return jsonify({'error': error}), 400
+    
+    job = submit_job(url, options, callback_url)
+    logger.info(f"Job {job['id']} queued for {url}")
+    return jsonify({
+        'job_id': job['id'],
+        'status': job['status'],
+        'status_url': f"/api/jobs/{job['id']}"
+    }), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_get_job(job_id):
+    job = load_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/stats', methods=['GET'])
+def api_stats():
+    return jsonify({
+        'http_pool': http_client.pool_stats(),
+        'image_cache': dict(image_cache.stats, hit_rate=image_cache.hit_rate()),
+        'result_cache': result_cache.stats,
+        'browser_pool': browser_pool.stats,
+        'host_scheduler': host_scheduler.stats,
+        'admission': dict(admission.stats, limit=admission.limit, running=admission.running, draining=admission.draining)
+    })
+
+def sampled_metrics():
+    lookups = sum(result_cache.stats.values()) - result_cache.stats['bypass'] - result_cache.stats['pruned']
+    pool = http_client.pool_stats()
+    return [
+        ('browser_launches_total', 'counter', 'Browsers launched by the pool', [({}, browser_pool.stats['launches'])]),
+        ('browser_crashes_total', 'counter', 'Browsers found disconnected', [({}, browser_pool.stats['crashes'])]),
+        ('browser_recycles_total', 'counter', 'Browsers closed after rendering their page quota', [({}, browser_pool.stats['recycles'])]),
+        ('browser_pages_total', 'counter', 'Pages rendered by the browser pool', [({}, browser_pool.stats['pages'])]),
+        ('image_cache_lookups_total', 'counter', 'Image cache lookups by result',
+         [({'result': key}, value) for key, value in image_cache.stats.items() if key != 'evictions']),
+        ('image_cache_evictions_total', 'counter', 'Images evicted from the image cache', [({}, image_cache.stats['evictions'])]),
+        ('image_cache_hit_ratio', 'gauge', 'Share of image lookups served from the cache', [({}, image_cache.hit_rate())]),
+        ('result_cache_requests_total', 'counter', 'Result cache requests by status',
+         [({'status': key}, value) for key, value in result_cache.stats.items() if key != 'pruned']),
+        ('result_cache_pruned_total', 'counter', 'Files pruned from the on-disk result cache', [({}, result_cache.stats['pruned'])]),
+        ('result_cache_hit_ratio', 'gauge', 'Share of result lookups served from the cache',
+         [({}, (result_cache.stats['hit'] + result_cache.stats['revalidated'] + result_cache.stats['fingerprint']) / lookups
+                if lookups else 0.0)]),
+        ('http_connections_opened', 'gauge', 'Connections opened by the HTTP pool', [({}, pool['connections_opened'])]),
+        ('http_connections_reused', 'gauge', 'Requests served on a reused connection', [({}, pool['connections_reused'])]),
+        ('host_throttled_total', 'counter', 'Throttling answers received from hosts', [({}, host_scheduler.stats['throttled'])]),
+        ('analyses_running', 'gauge', 'Analyses currently running', [({}, admission.running)]),
+        ('analyses_limit', 'gauge', 'Maximum number of analyses running at once', [({}, admission.limit)]),
+        ('analyses_rejected_total', 'counter', 'Analyses rejected because the server was saturated or draining',
+         [({}, admission.stats['rejected'])])
+    ]
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(sampled_metrics()), mimetype='text/plain; version=0.0.4')
+
 # HTML template for the simplified home page
 HOME_TEMPLATE = '''
 <!DOCTYPE html>
@@ -451,39 +517,53 @@ HOME_TEMPLATE = '''
         }
     </style>
     <script>
+        function setProgress(percent, message) {
+            document.getElementById('progress-bar').style.width = percent + '%';
+            document.getElementById('progress-message').innerText = message;
+        }
+        
+        function pollJob(jobId) {
+            fetch('/api/jobs/' + jobId)
+                .then(response => response.json())
+                .then(job => {
+                    setProgress(job.progress.percent, job.progress.message);
+                    if (job.status === 'done' || job.status === 'failed') {
+                        window.location = '/jobs/' + jobId;
+                    } else {
+                        setTimeout(() => pollJob(jobId), 1000);
+                    }
+                })
+                .catch(() => setTimeout(() => pollJob(jobId), 2000));
+        }
+        
         function startAnalysis() {
+            const form = document.getElementById('analysis-form');
+            
             // Show progress indicator
             document.getElementById('progress-container').style.display = 'block';
             document.getElementById('analyze-button').disabled = true;
-            document.getElementById('progress-message').innerText = 'Analyzing static images...';
+            setProgress(0, 'Preparing analysis...');
             
-            // Simulate progress steps
-            setTimeout(() => {
-                document.getElementById('progress-bar').style.width = '20%';
-            }, 500);
-            
-            setTimeout(() => {
-                document.getElementById('progress-bar').style.width = '40%';
-                document.getElementById('progress-message').innerText = 'Checking meta tags...';
-            }, 2000);
-            
-            setTimeout(() => {
-                document.getElementById('progress-bar').style.width = '60%';
-                document.getElementById('progress-message').innerText = 'Analyzing dynamic images...';
-            }, 3500);
-            
-            setTimeout(() => {
-                document.getElementById('progress-bar').style.width = '80%';
-                document.getElementById('progress-message').innerText = 'Evaluating Google Discover compatibility...';
-            }, 5000);
-            
-            setTimeout(() => {
-                document.getElementById('progress-bar').style.width = '100%';
-                document.getElementById('progress-message').innerText = 'Analysis complete, processing results...';
-            }, 6000);
-            
-            // Submit the form
-            document.getElementById('analysis-form').submit();
+            fetch('/api/jobs', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({
+                    url: form.elements['url'].value,
+                    render_mode: form.elements['lean_render'].checked ? 'lean' : 'full',
+                    bypass_cache: form.elements['bypass_cache'].checked
+                })
+            })
+                .then(response => response.json().then(data => ({ok: response.ok, data: data})))
+                .then(({ok, data}) => {
+                    if (!ok) {
+                        throw new Error(data.error);
+                    }
+                    pollJob(data.job_id);
+                })
+                .catch(() => {
+                    // Fall back to the synchronous form submission
+                    form.submit();
+                });
         }
     </script>
 </head>
@@ -508,6 +588,10 @@ HOME_TEMPLATE = '''
                 <input type="text" id="url" name="url" placeholder="https://example.com" required pattern="^https?://.*" title="Please enter a valid URL starting with http:// or https://">
                 <button type="submit" id="analyze-button">Analyze</button>
             </div>
+            <div class="form-group">
+                <label><input type="checkbox" name="lean_render" value="1"> Lean render (faster, skips fonts, media, ads and trackers)</label><br>
+                <label><input type="checkbox" name="bypass_cache" value="1"> Force a fresh analysis (ignore cached results)</label>
+            </div>
         </form>
         
         <div id="progress-container" class="progress-container" style="display: none;">
@@ -528,16 +612,29 @@ HOME_TEMPLATE = '''
             </div>
             <h2>Analysis Results</h2>
             
-            {% if not results.analysis_info.dynamic_analysis_success %}
+            {% if 'dynamic' in results.analysis_info.stopped_early %}
+            <div class="analysis-info">
+                <p><strong>Note:</strong> Dynamic analysis was stopped early because the static analysis already proved compatibility.</p>
+            </div>
+            {% elif not results.analysis_info.dynamic_analysis_success %}
             <div class="analysis-info warning">
                 <p><strong>Note:</strong> Dynamic analysis failed or timed out. Results are based on static analysis only ({{ results.analysis_info.total_static_images }} images found).</p>
             </div>
             {% endif %}
             
+            {% set timed_out_images = results.analysis_info.skipped_images.values()|select('equalto', 'timed out')|list %}
+            {% if timed_out_images %}
+            <div class="analysis-info warning">
+                <p><strong>Note:</strong> {{ timed_out_images|length }} images could not be checked before the page deadline and were skipped.</p>
+            </div>
+            {% endif %}
+            
             <div class="result-section">
                 <h3>Meta Robots Tag</h3>
                 {% if results.robots_meta.max_image_preview_large_found %}
                 <p class="success">✓ Meta robots tag with max-image-preview:large found</p>
+                {% elif results.robots_meta.noindex %}
+                <p class="warning">⚠ The page is excluded from the index (noindex), it cannot appear in Google Discover</p>
                 {% else %}
                 <p class="warning">⚠ Meta robots tag with max-image-preview:large not found</p>
                 <p>Google recommends adding <code>&lt;meta name="robots" content="max-image-preview:large"&gt;</code> in the head section of your page.</p>
@@ -602,16 +699,18 @@ def analyze_form():
         return render_template_string(HOME_TEMPLATE, error="URL missing in request")
     
     # Clean up URL before validation
-    url = url.strip()
-    if url.startswith('examphttps://'):
-        url = url.replace('examphttps://', 'https://')
-    if url.endswith('/le.com'):
-        url = url[:-7]
+    url = clean_url(url)
         
     if not is_valid_url(url):
         return render_template_string(HOME_TEMPLATE, error=f"Invalid URL format: {url}")
     
-    results, error = analyze_url(url)
+    render_mode = 'lean' if request.form.get('lean_render') else 'full'
+    try:
+        results, error = analyze_url_cached(url, render_mode=render_mode, bypass_cache=bool(request.form.get('bypass_cache')),
+                                            admission_timeout=ADMISSION_QUEUE_TIMEOUT)
+    except ServerBusy as e:
+        logger.warning(f"Analysis of {url} rejected: {str(e)}")
+        return render_template_string(HOME_TEMPLATE, error=f"{str(e)}, please retry in a few seconds"), 503, {'Retry-After': str(ADMISSION_RETRY_AFTER)}
     
     if error:
         return render_template_string(HOME_TEMPLATE, error=f"Error during analysis: {error}")
@@ -619,5 +718,32 @@ def analyze_form():
     logger.info("Analysis completed successfully")
     return render_template_string(HOME_TEMPLATE, results=results)
 
+@app.route('/jobs/<job_id>')
+def job_page(job_id):
+    job = load_job(job_id)
+    if not job:
+        return render_template_string(HOME_TEMPLATE, error="Analysis not found"), 404
+    if job['status'] == 'failed':
+        return render_template_string(HOME_TEMPLATE, error=f"Error during analysis: {job['error']}")
+    if job['status'] != 'done':
+        return render_template_string(HOME_TEMPLATE, error="Analysis still in progress, please reload this page in a moment")
+    return render_template_string(HOME_TEMPLATE, results=job['result'])
+
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get('SHUTDOWN_DRAIN_TIMEOUT', 120))
+
+def start_background_workers():
+    resume_jobs()
+    browser_pool.start()
+
+def shutdown_gracefully(timeout=SHUTDOWN_DRAIN_TIMEOUT):
+    # Stops admitting analyses and waits for the running ones before closing the browsers.
+    # Jobs still queued stay on disk and are resumed by the next process.
+    logger.info(f"Draining {admission.running} running analyses")
+    if not admission.drain(timeout):
+        logger.warning(f"{admission.running} analyses still running after {timeout:.0f}s, shutting down anyway")
+    job_executor.shutdown(wait=False, cancel_futures=True)
+    browser_pool.shutdown()
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001) 
\ No newline at end of file
+    start_background_workers()
+    app.run(host='0.0.0.0', port=5001) 
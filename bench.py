@@ -0,0 +1,323 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+
+# Every run starts cold: image sizes from a previous run would hide the fetch cost
+os.environ.setdefault('IMAGE_CACHE_PATH', '')
+
+from PIL import Image
+
+from analyzer import (
+    configure_logging, analyze_static_images, analyze_dynamic_images, browser_pool, RENDER_MODES,
+    HOST_MAX_RATE, STATIC_IMAGE_MAX_WORKERS, STATIC_IMAGE_MAX_PER_HOST, BROWSER_POOL_SIZE
+)
+
+# Console only, and before app is imported: its log file setup is then a no-op and
+# benchmark runs never write to logs/app.log. Spawned mode processes run this too.
+configure_logging()
+
+MODES = ('static', 'dynamic', 'api')
+PAGE_KINDS = ('many_images', 'huge_html', 'lazy', 'slow_hosts', 'srcset')
+IMAGE_SIZES = [(1600, 900), (1200, 675), (800, 450), (400, 300), (150, 150)]
+SRCSET_WIDTHS = (320, 480, 640, 960, 1280, 1920)
+# Metric name -> True when a higher value is better
+COMPARED_METRICS = {
+    'throughput_pages_per_s': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+    'peak_rss_mb': False,
+    'bytes_transferred': False
+}
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Probes drop their connection as soon as they know the image size
+        pass
+
+class FixtureSite:
+    # Serves the synthetic corpus from three local servers, so the site, a slow
+    # image host and an erroring image host count as separate hosts
+    def __init__(self, slow_delay):
+        self.slow_delay = slow_delay
+        self.lock = threading.Lock()
+        self.images = {}
+        self.bytes_sent = 0
+        self.requests = 0
+        self.servers = {role: QuietHTTPServer(('127.0.0.1', 0), self._handler(role)) for role in ('site', 'slow', 'error')}
+
+    def base(self, role):
+        return f"http://127.0.0.1:{self.servers[role].server_address[1]}"
+
+    def start(self):
+        for server in self.servers.values():
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def reset_counters(self):
+        with self.lock:
+            self.bytes_sent = 0
+            self.requests = 0
+
+    def page_urls(self, pages_per_kind):
+        return [f"{self.base('site')}/article/{kind}/{i}.html" for i in range(pages_per_kind) for kind in PAGE_KINDS]
+
+    def image(self, width, height):
+        key = (width, height)
+        with self.lock:
+            data = self.images.get(key)
+        if data is None:
+            buffer = BytesIO()
+            Image.new('RGB', key, ((width * 7) % 256, (height * 3) % 256, 128)).save(buffer, 'JPEG', quality=40)
+            data = buffer.getvalue()
+            with self.lock:
+                self.images[key] = data
+        return data
+
+    def _handler(self, role):
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, status, body=b'', content_type='text/html; charset=utf-8', headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+                with fixture.lock:
+                    fixture.bytes_sent += len(body)
+                    fixture.requests += 1
+
+            def do_GET(self):
+                parts = self.path.strip('/').split('/')
+                if role == 'slow':
+                    time.sleep(fixture.slow_delay)
+                if role == 'error':
+                    if parts[-1].startswith('429'):
+                        return self.send(429, headers={'Retry-After': '1'})
+                    return self.send(500)
+                if parts[0] == 'article' and len(parts) == 3 and parts[1] in PAGE_KINDS:
+                    return self.send(200, render_page(fixture, parts[1], parts[2].split('.')[0]).encode('utf-8'))
+                if parts[0] == 'img':
+                    try:
+                        width, height = (int(value) for value in parts[-1].split('.')[0].split('x'))
+                    except ValueError:
+                        return self.send(404)
+                    return self.send(200, fixture.image(width, height), 'image/jpeg', {'Cache-Control': 'max-age=3600'})
+                self.send(404)
+
+        return Handler
+
+def img_path(base, width, height, variant=''):
+    return f"{base}/img/{variant}{width}x{height}.jpg"
+
+def render_page(fixture, kind, index):
+    site = fixture.base('site')
+    body = []
+    if kind == 'many_images':
+        # Small images first, the only large one at the very end
+        for i in range(80):
+            width, height = IMAGE_SIZES[1 + i % 4]
+            body.append(f'<img src="{img_path(site, width + i, height)}" alt="image {i}">')
+        body.append(f'<img src="{img_path(site, 1600, 900)}" alt="hero">')
+    elif kind == 'huge_html':
+        paragraph = '<p>' + 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 20 + '</p>'
+        body.extend(paragraph for _ in range(2500))
+        body.append(f'<img src="{img_path(site, 1600, 900)}" alt="hero">')
+    elif kind == 'lazy':
+        placeholder = 'data:image/gif;base64,R0lGODlhAQABAAAAACw='
+        for i in range(30):
+            width, height = IMAGE_SIZES[i % len(IMAGE_SIZES)]
+            body.append('<div style="height:1500px"></div>')
+            body.append(f'<img src="{placeholder}" data-src="{img_path(site, width, height + i)}" loading="lazy" alt="lazy {i}">')
+    elif kind == 'slow_hosts':
+        for i in range(10):
+            body.append(f'<img src="{img_path(fixture.base("slow"), 1300 + i, 700)}" alt="slow {i}">')
+            body.append(f'<img src="{img_path(fixture.base("error"), 1400 + i, 700, "500-")}" alt="error {i}">')
+            body.append(f'<img src="{img_path(fixture.base("error"), 1500 + i, 700, "429-")}" alt="throttled {i}">')
+        body.append(f'<img src="{img_path(site, 800, 450)}" alt="small">')
+    elif kind == 'srcset':
+        for i in range(20):
+            srcset = ', '.join(f'{img_path(site, width, width * 9 // 16 + i)} {width}w' for width in SRCSET_WIDTHS)
+            body.append(
+                f'<picture><source type="image/jpeg" srcset="{srcset}" sizes="100vw">'
+                f'<img src="{img_path(site, 640, 360 + i)}" srcset="{srcset}" sizes="(max-width: 800px) 100vw, 800px" alt="responsive {i}">'
+                '</picture>'
+            )
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8">'
+        f'<title>Benchmark {kind} {index}</title>'
+        '<meta name="robots" content="index, follow, max-image-preview:large">'
+        f'<meta property="og:image" content="{img_path(site, 1200, 630)}">'
+        '</head><body><article>' + '\n'.join(body) + '</article></body></html>'
+    )
+
+def percentile(values, p):
+    # Nearest-rank percentile
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux. Chromium runs in child processes and is not included.
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def analyze_once(mode, url, render_mode):
+    # Returns True when the analysis produced a result
+    if mode == 'static':
+        return bool(analyze_static_images(url)[0])
+    if mode == 'dynamic':
+        return bool(analyze_dynamic_images(url, render_mode=render_mode)[0])
+    # Only the api mode needs Flask
+    from app import app
+    response = app.test_client().post('/api/analyze', json={'url': url, 'render_mode': render_mode, 'bypass_cache': True})
+    return response.status_code == 200
+
+def run_mode(fixture, mode, urls, concurrency, render_mode, warmup):
+    for url in urls[:warmup]:
+        analyze_once(mode, url, render_mode)
+    fixture.reset_counters()
+    latencies = []
+    errors = [0]
+
+    def timed(url):
+        started = time.monotonic()
+        try:
+            ok = analyze_once(mode, url, render_mode)
+        except Exception:
+            ok = False
+        latencies.append(time.monotonic() - started)
+        if not ok:
+            errors[0] += 1
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, urls))
+    wall = time.monotonic() - started
+    return {
+        'pages': len(urls),
+        'errors': errors[0],
+        'wall_seconds': round(wall, 3),
+        'throughput_pages_per_s': round(len(urls) / wall, 3) if wall else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'peak_rss_mb': peak_rss_mb(),
+        'bytes_transferred': fixture.bytes_sent,
+        'requests_served': fixture.requests
+    }
+
+def run_isolated_mode(mode, pages_per_kind, concurrency, render_mode, slow_delay, warmup):
+    # Runs in a fresh process with its own fixture site, so peak_rss_mb only covers this mode
+    fixture = FixtureSite(slow_delay)
+    fixture.start()
+    try:
+        urls = fixture.page_urls(pages_per_kind)
+        return run_mode(fixture, mode, urls, concurrency, render_mode, warmup)
+    finally:
+        fixture.stop()
+        browser_pool.shutdown()
+
+def compare(report, baseline, tolerance):
+    # Returns one entry per metric, flagged when it moved the wrong way by more than tolerance
+    comparison = []
+    for mode, results in report['modes'].items():
+        previous = baseline.get('modes', {}).get(mode)
+        if not previous:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = previous.get(metric), results.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            comparison.append({
+                'mode': mode,
+                'metric': metric,
+                'baseline': old,
+                'current': new,
+                'change': round(change, 3),
+                'regression': change < -tolerance if higher_is_better else change > tolerance
+            })
+    return comparison
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the analyzer against a local synthetic site.')
+    parser.add_argument('--modes', default=','.join(MODES), help=f'comma separated list of {", ".join(MODES)}')
+    parser.add_argument('--pages-per-kind', type=int, default=4, help=f'pages generated for each of {", ".join(PAGE_KINDS)}')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of pages analyzed at the same time')
+    parser.add_argument('--render-mode', choices=RENDER_MODES, default='full', help='dynamic analysis render mode')
+    parser.add_argument('--slow-delay', type=float, default=3, help='seconds the slow image host waits before answering')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed analyses run before each mode')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    parser.add_argument('--baseline', help='compare the report with this stored report')
+    parser.add_argument('--save-baseline', help='store the report as a baseline in this file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change tolerated before a metric is a regression')
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f"Unknown mode: {mode}")
+
+    report = {
+        'config': {
+            'pages_per_kind': args.pages_per_kind,
+            'concurrency': args.concurrency,
+            'render_mode': args.render_mode,
+            'slow_delay': args.slow_delay,
+            'host_max_rate': HOST_MAX_RATE,
+            'static_image_max_workers': STATIC_IMAGE_MAX_WORKERS,
+            'static_image_max_per_host': STATIC_IMAGE_MAX_PER_HOST,
+            'browser_pool_size': BROWSER_POOL_SIZE
+        },
+        'modes': {}
+    }
+    pages = args.pages_per_kind * len(PAGE_KINDS)
+    for mode in modes:
+        print(f"Running {mode} benchmark on {pages} pages...", file=sys.stderr)
+        # ru_maxrss never goes down, a process per mode keeps the peaks of other modes out
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            report['modes'][mode] = executor.submit(
+                run_isolated_mode, mode, args.pages_per_kind, args.concurrency, args.render_mode,
+                args.slow_delay, args.warmup
+            ).result()
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['comparison'] = compare(report, json.load(f), args.tolerance)
+        regressions = [entry for entry in report['comparison'] if entry['regression']]
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
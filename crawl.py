@@ -0,0 +1,55 @@
+import argparse
+import json
+import os
+import sys
+
+from analyzer import (
+    configure_logging, crawl_site, clean_url, is_valid_url, RENDER_MODES, BATCH_MAX_CONCURRENCY, BATCH_MAX_RUNTIME,
+    CRAWL_MAX_URLS, CRAWL_STATE_PATH
+)
+
+def main():
+    parser = argparse.ArgumentParser(description='Audit the Google Discover compatibility of a whole site from its sitemap or RSS/Atom feed.')
+    parser.add_argument('source', help='URL of a sitemap, sitemap index, RSS or Atom feed')
+    parser.add_argument('--concurrency', type=int, default=BATCH_MAX_CONCURRENCY, help='number of pages analyzed at the same time')
+    parser.add_argument('--max-runtime', type=float, default=BATCH_MAX_RUNTIME, help='maximum crawl duration in seconds')
+    parser.add_argument('--max-urls', type=int, default=CRAWL_MAX_URLS, help='maximum number of pages analyzed')
+    parser.add_argument('--render-mode', choices=RENDER_MODES, default='full', help='dynamic analysis render mode')
+    parser.add_argument('--early-exit', action='store_true', help='stop probing images once one of at least 1200px is confirmed')
+    parser.add_argument('--force', action='store_true', help='re-analyze pages even if their lastmod did not change')
+    parser.add_argument('--state', default=CRAWL_STATE_PATH, help='SQLite file remembering previous crawls')
+    parser.add_argument('--output', help='write page results as NDJSON to this file')
+    args = parser.parse_args()
+    configure_logging(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'app.log'))
+
+    source = clean_url(args.source)
+    if not is_valid_url(source):
+        parser.error(f"Invalid URL format: {source}")
+
+    options = {
+        'render_mode': args.render_mode,
+        'block_stylesheets': False,
+        'reuse_html': False,
+        'early_exit': args.early_exit,
+        'bypass_cache': False
+    }
+    output = open(args.output, 'a') if args.output else None
+    report = None
+    try:
+        for line in crawl_site(source, options, args.concurrency, args.max_runtime, args.max_urls,
+                               force=args.force, state_path=args.state):
+            if 'report' in line:
+                report = line['report']
+            elif output:
+                output.write(json.dumps(line) + '\n')
+                output.flush()
+    finally:
+        if output:
+            output.close()
+
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0 if report and not report['totals']['errors'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,31 @@
+import os
+import signal
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5001')}"
+# Every worker runs its own browser pool, so keep a single worker unless memory allows more
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 16))
+# Must stay above ANALYSIS_DEADLINE so a long analysis is not killed mid-request
+timeout = int(os.environ.get('WEB_TIMEOUT', 180))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 150))
+keepalive = 5
+accesslog = '-'
+
+def post_worker_init(worker):
+    # Browser threads and job workers do not survive a fork, they start in each worker
+    from app import admission, start_background_workers
+    start_background_workers()
+
+    # Stop admitting analyses as soon as the worker is asked to stop
+    handle_exit = worker.handle_exit
+
+    def drain_and_exit(sig, frame):
+        admission.start_draining()
+        handle_exit(sig, frame)
+    signal.signal(signal.SIGTERM, drain_and_exit)
+
+def worker_exit(server, worker):
+    # In-flight requests are done, wait for background jobs with what is left of the grace period
+    from app import admission, shutdown_gracefully
+    shutdown_gracefully(max(graceful_timeout - admission.draining_for() - 5, 0))
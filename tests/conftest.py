@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The engine is imported from the repository root, without a persistent image cache
+os.environ.setdefault('IMAGE_CACHE_PATH', '')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
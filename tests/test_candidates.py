@@ -0,0 +1,72 @@
+from analyzer import parse_srcset, parse_dimension, collect_image_candidates, extract_page_data
+
+BASE_URL = 'https://example.com/article/'
+
+def candidates_of(html):
+    return collect_image_candidates(extract_page_data([html.encode()], 'utf-8'), BASE_URL)
+
+def test_srcset_width_and_density_descriptors():
+    assert parse_srcset('a.jpg 480w, b.jpg 1600w') == [('a.jpg', 480, None), ('b.jpg', 1600, None)]
+    assert parse_srcset('a.jpg, b.jpg 2x,c.jpg 1.5x') == [('a.jpg', None, 1.0), ('b.jpg', None, 2.0), ('c.jpg', None, 1.5)]
+
+def test_srcset_urls_may_contain_commas():
+    srcset = ('https://res.cloudinary.com/demo/image/upload/w_400,c_scale/sample.jpg 400w, '
+              'https://res.cloudinary.com/demo/image/upload/w_1600,c_scale/sample.jpg 1600w')
+    assert parse_srcset(srcset) == [
+        ('https://res.cloudinary.com/demo/image/upload/w_400,c_scale/sample.jpg', 400, None),
+        ('https://res.cloudinary.com/demo/image/upload/w_1600,c_scale/sample.jpg', 1600, None),
+    ]
+
+def test_srcset_trailing_comma_and_empty():
+    assert parse_srcset('a.jpg,') == [('a.jpg', None, 1.0)]
+    assert parse_srcset('') == []
+    assert parse_srcset(None) == []
+
+def test_parse_dimension():
+    assert parse_dimension('1200px') == 1200
+    assert parse_dimension({'@type': 'QuantitativeValue', 'value': 1600}) == 1600
+    assert parse_dimension('50%') is None
+    assert parse_dimension('auto') is None
+
+def test_largest_srcset_variant_ranked_first():
+    ranked, skipped = candidates_of('''
+        <img src="small.jpg" width="300" height="200">
+        <img src="https://res.cloudinary.com/demo/image/upload/w_400,c_scale/x.jpg"
+             srcset="https://res.cloudinary.com/demo/image/upload/w_400,c_scale/x.jpg 400w,
+                     https://res.cloudinary.com/demo/image/upload/w_1600,c_scale/x.jpg 1600w">
+    ''')
+    assert ranked[0]['url'] == 'https://res.cloudinary.com/demo/image/upload/w_1600,c_scale/x.jpg'
+    assert ranked[0]['declared_width'] == 1600
+    # Splitting at the first comma used to produce this relative URL
+    assert 'https://example.com/article/c_scale/x.jpg' not in [c['url'] for c in ranked] + list(skipped)
+    assert skipped['https://res.cloudinary.com/demo/image/upload/w_400,c_scale/x.jpg'] == 'declared width below 1200px'
+
+def test_icons_vectors_and_data_urls_are_skipped():
+    ranked, skipped = candidates_of('''
+        <img src="/pixel.gif" width="1" height="1">
+        <img src="/logo.svg">
+        <img src="data:image/png;base64,AAAA">
+        <img src="/photo.jpg" width="50%">
+    ''')
+    assert [c['url'] for c in ranked] == ['https://example.com/photo.jpg']
+    assert skipped == {
+        'https://example.com/pixel.gif': 'icon or tracking pixel',
+        'https://example.com/logo.svg': 'vector image'
+    }
+
+def test_og_image_and_json_ld_size_hints():
+    ranked, skipped = candidates_of('''
+        <html><head>
+        <meta property="og:image" content="https://cdn.example.com/og.jpg">
+        <meta property="og:image:width" content="1200">
+        <script type="application/ld+json">
+        {"@type": "NewsArticle", "image": {"@type": "ImageObject", "url": "https://cdn.example.com/hero.jpg", "width": 2000}}
+        </script>
+        </head><body><img src="/inline.jpg" width="800"></body></html>
+    ''')
+    assert [c['url'] for c in ranked] == [
+        'https://cdn.example.com/hero.jpg',
+        'https://cdn.example.com/og.jpg',
+        'https://example.com/inline.jpg'
+    ]
+    assert ranked[0]['origin'] == 'json-ld'
@@ -0,0 +1,61 @@
+import struct
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from analyzer import parse_image_header, ImageHeaderNeedMoreData
+
+def encode(image_format, size=(1600, 900), **params):
+    buffer = BytesIO()
+    Image.new('RGB', size, (200, 100, 50)).save(buffer, image_format, **params)
+    return buffer.getvalue()
+
+def box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+def avif(width, height):
+    ispe = box(b'ispe', b'\x00\x00\x00\x00' + struct.pack('>II', width, height))
+    meta = box(b'meta', b'\x00\x00\x00\x00' + box(b'hdlr', b'\x00' * 24) + box(b'iprp', box(b'ipco', ispe)))
+    return box(b'ftyp', b'avif\x00\x00\x00\x00mif1') + meta + box(b'mdat', b'\x00' * 16)
+
+@pytest.mark.parametrize('image_format, expected', [
+    ('PNG', 'PNG'),
+    ('GIF', 'GIF'),
+    ('JPEG', 'JPEG'),
+])
+def test_common_formats(image_format, expected):
+    assert parse_image_header(encode(image_format)) == (1600, 900, expected)
+
+def test_progressive_jpeg_with_exif():
+    data = encode('JPEG', progressive=True, exif=b'Exif\x00\x00' + b'\x00' * 64)
+    assert parse_image_header(data) == (1600, 900, 'JPEG')
+
+@pytest.mark.parametrize('params', [{'lossless': False}, {'lossless': True}, {'lossless': False, 'exif': b'Exif\x00\x00'}])
+def test_webp_variants(params):
+    # Lossy (VP8), lossless (VP8L) and extended (VP8X) chunks
+    assert parse_image_header(encode('WEBP', **params)) == (1600, 900, 'WEBP')
+
+def test_avif_uses_largest_ispe():
+    assert parse_image_header(avif(2048, 1152)) == (2048, 1152, 'AVIF')
+
+def test_avif_without_ispe_before_media_data():
+    data = box(b'ftyp', b'avif\x00\x00\x00\x00mif1') + box(b'mdat', b'\x00' * 16)
+    with pytest.raises(ValueError):
+        parse_image_header(data)
+
+@pytest.mark.parametrize('data', [
+    encode('PNG')[:20],
+    encode('GIF')[:8],
+    encode('JPEG', exif=b'Exif\x00\x00' + b'\x00' * 2000)[:100],
+    encode('WEBP')[:20],
+    avif(2048, 1152)[:40],
+    b'\xff\xd8',
+])
+def test_truncated_input_asks_for_more_data(data):
+    with pytest.raises(ImageHeaderNeedMoreData):
+        parse_image_header(data)
+
+def test_unsupported_format():
+    with pytest.raises(ValueError):
+        parse_image_header(b'<svg xmlns="http://www.w3.org/2000/svg"></svg>')
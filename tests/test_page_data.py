@@ -0,0 +1,49 @@
+import pytest
+
+import analyzer
+from analyzer import detect_html_encoding, extract_page_data, normalize_encoding
+
+class FakeResponse:
+    def __init__(self, content_type, encoding):
+        self.headers = {'Content-Type': content_type}
+        self.encoding = encoding
+
+@pytest.fixture(params=['lxml', 'stdlib'])
+def html_parser(request, monkeypatch):
+    # Production may run without lxml, both extraction paths must agree
+    if request.param == 'stdlib':
+        monkeypatch.setattr(analyzer, 'lxml_etree', None)
+    elif analyzer.lxml_etree is None:
+        pytest.skip('lxml is not installed')
+    return request.param
+
+def test_extracts_robots_and_images(html_parser):
+    html = '''<html><head><meta name="Robots" content="max-image-preview:large">
+        <meta property="og:image" content="/og.jpg"></head>
+        <body><img src="a.jpg" width="1600" height="900"></body></html>'''
+    page_data = extract_page_data([html.encode()], 'utf-8')
+    assert page_data['robots_metas'] == [{'name': 'robots', 'content': 'max-image-preview:large'}]
+    assert [img['src'] for img in page_data['images']] == ['a.jpg']
+
+def test_multibyte_character_split_across_chunks(html_parser):
+    body = '<html><head><meta name="robots" content="max-image-preview:large"></head><body><img alt="é" src="b.jpg"></body></html>'.encode()
+    cut = body.index('é'.encode()) + 1
+    page_data = extract_page_data([body[:cut], body[cut:]], 'utf-8')
+    assert [img['src'] for img in page_data['images']] == ['b.jpg']
+
+@pytest.mark.parametrize('charset', ['utf8mb4', 'none', ''])
+def test_unknown_header_charset_falls_back_to_utf8(charset, html_parser):
+    encoding = detect_html_encoding(b'<html><head>', FakeResponse(f'text/html; charset={charset}', charset))
+    assert encoding == 'utf-8'
+    page_data = extract_page_data(['<img src="é.jpg">'.encode()], encoding)
+    assert [img['src'] for img in page_data['images']] == ['é.jpg']
+
+def test_meta_charset_wins_over_header():
+    response = FakeResponse('text/html; charset=utf-8', 'utf-8')
+    assert detect_html_encoding(b'<meta charset="ISO-8859-1">', response) == 'iso8859-1'
+    assert detect_html_encoding(b'<meta charset="utf8mb4">', response) == 'utf-8'
+
+def test_normalize_encoding():
+    assert normalize_encoding('UTF8') == 'utf-8'
+    assert normalize_encoding('latin1') == 'iso8859-1'
+    assert normalize_encoding(None) == 'utf-8'
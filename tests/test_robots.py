@@ -0,0 +1,60 @@
+from analyzer import parse_robots_directives
+
+def metas(**contents):
+    return [{'name': name, 'content': content} for name, content in contents.items()]
+
+def test_max_image_preview_large():
+    directives = parse_robots_directives(metas(robots='index, follow, max-image-preview:large'))
+    assert directives['max_image_preview'] == 'large'
+    assert directives['max_image_preview_large']
+    assert not directives['noindex']
+
+def test_spaces_and_case_are_normalised():
+    assert parse_robots_directives(metas(robots='Max-Image-Preview : LARGE'))['max_image_preview_large']
+
+def test_most_restrictive_preview_wins():
+    directives = parse_robots_directives(metas(robots='max-image-preview:large', googlebot='max-image-preview:standard'))
+    assert directives['max_image_preview'] == 'standard'
+    assert not directives['max_image_preview_large']
+
+def test_noindex_and_none_cancel_large_preview():
+    for content in ('noindex, max-image-preview:large', 'none, max-image-preview:large'):
+        directives = parse_robots_directives(metas(robots=content))
+        assert directives['noindex']
+        assert not directives['max_image_preview_large']
+
+def test_other_crawlers_metas_are_ignored():
+    directives = parse_robots_directives(metas(robots='max-image-preview:large', bingbot='noindex'))
+    assert directives['max_image_preview_large']
+    assert [source['source'] for source in directives['sources']] == ['meta:robots']
+
+def test_x_robots_tag_alone():
+    directives = parse_robots_directives([], 'max-image-preview:large')
+    assert directives['max_image_preview_large']
+    assert directives['sources'] == [{'source': 'header:x-robots-tag', 'content': 'max-image-preview:large'}]
+
+def test_x_robots_tag_can_restrict_the_meta():
+    directives = parse_robots_directives(metas(robots='max-image-preview:large'), 'noindex')
+    assert directives['noindex']
+    assert not directives['max_image_preview_large']
+
+def test_x_robots_tag_user_agent_prefix_applies_to_following_directives():
+    header = 'bingbot: noindex, max-image-preview:none, googlebot: max-image-preview:large'
+    directives = parse_robots_directives([], header)
+    assert directives['max_image_preview_large']
+    assert not directives['noindex']
+
+def test_x_robots_tag_googlebot_prefix_is_honoured():
+    directives = parse_robots_directives(metas(robots='max-image-preview:large'), 'googlebot: noindex')
+    assert directives['noindex']
+    assert not directives['max_image_preview_large']
+
+def test_x_robots_tag_valued_directive_is_not_a_user_agent():
+    header = 'unavailable_after: 25 Jun 2030 15:00:00 PST, max-image-preview:large'
+    assert parse_robots_directives([], header)['max_image_preview_large']
+
+def test_no_directives():
+    directives = parse_robots_directives([])
+    assert directives['max_image_preview'] is None
+    assert not directives['max_image_preview_large']
+    assert directives['directives'] == []